@@ -12,7 +12,7 @@ MAX_PING = 300
 
 # Адрес для прослушивания локального SOCKS5 сервера
 # 127.0.0.1 - только локальные подключения (рекомендуется)
-# 0.0.0.0 - все подключения (НЕБЕЗОПАСНО для публичных сетей!)
+# 0.0.0.0 - все подключения (НЕБЕЗОПАСНО для публичных сетей без CLIENT_AUTH!)
 LOCAL_HOST = "127.0.0.1"
 
 # Порт локального SOCKS5 сервера
@@ -30,6 +30,10 @@ CONNECTION_TIMEOUT = 10  # Таймаут подключения к upstream п
 CLIENT_TIMEOUT = 10      # Таймаут ожидания данных от клиента
 SOCKS_TIMEOUT = 5        # Таймаут SOCKS5 handshake
 
+# Смена upstream прокси при ошибках
+MAX_CONNECTION_ERRORS = 3  # Ошибок подряд до blacklist и смены прокси
+MIN_SWITCH_INTERVAL = 30   # Минимальный интервал между сменами (секунды)
+
 # Логирование
 # True - включить подробное логирование (все ошибки)
 # False - минимальное логирование (только важные события)
@@ -51,3 +55,116 @@ EXCLUDED_COUNTRIES = []
 # 0 - не фильтровать по времени
 MIN_PROXY_AGE = 0
 
+
+# Мониторинг задержки event loop
+# Отдельный поток периодически проверяет, как быстро event loop отвечает.
+# Блокировки дольше SLOW_CALLBACK_THRESHOLD записываются вместе со стеком
+# и доступны в /api/status (раздел event_loop) и /metrics
+LOOP_MONITOR = True
+LOOP_LAG_INTERVAL = 0.25        # Интервал замеров (секунды)
+LOOP_LAG_WINDOW = 2400          # Сколько последних замеров хранить для перцентилей
+SLOW_CALLBACK_THRESHOLD = 0.1   # Порог медленного callback (секунды)
+SLOW_CALLBACK_HISTORY = 20      # Сколько последних блокировок хранить
+
+# Striping: распределение параллельных соединений клиента по нескольким upstream
+# Telegram открывает несколько соединений (основное, медиа, загрузка файлов).
+# При STRIPING_ENABLED = True они распределяются по STRIPING_TOP_K самым
+# здоровым прокси, а соединения к одному DC закрепляются за одним upstream
+STRIPING_ENABLED = False
+STRIPING_TOP_K = 3
+STRIPING_STICKY_TTL = 600       # Время жизни привязки клиент+DC -> upstream (секунды)
+THROUGHPUT_INTERVAL = 10        # Интервал замера пропускной способности (секунды)
+
+# Проверка новых прокси перед использованием
+# Кандидаты из загруженного списка параллельно проходят SOCKS5 приветствие и
+# CONNECT к тестовому адресу. В работу попадают только прошедшие проверку,
+# причем сразу по мере прохождения, не дожидаясь проверки всего списка.
+# При обновлении прежний список работает, пока не пройдут STRIPING_TOP_K прокси,
+# а текущий прокси меняется, только если его нет в новом списке
+QUALIFY_ENABLED = True
+QUALIFY_CONCURRENCY = 50              # Сколько прокси проверять одновременно
+QUALIFY_TIMEOUT = 5                   # Таймаут проверки одного прокси (секунды)
+QUALIFY_TARGET_HOST = "149.154.167.51"  # Тестовый адрес (Telegram DC2)
+QUALIFY_TARGET_PORT = 443
+
+# Перезагрузка без остановки (Linux/macOS)
+# kill -HUP <pid>  - перечитать config.py (LOCAL_HOST/LOCAL_PORT и HTTP_CONNECT_* требуют перезапуска)
+# kill -USR2 <pid> - запустить новый процесс, передать ему слушающие сокеты и
+#                    состояние upstream прокси, а текущие соединения довести до конца
+HANDOVER_TIMEOUT = 30   # Сколько ждать готовности нового процесса (секунды)
+DRAIN_TIMEOUT = 300     # Сколько ждать завершения старых соединений (секунды)
+
+# Разрешение доменных имен
+# "remote" - имена из запросов клиента передаются upstream прокси как есть
+# "local"  - имена разрешаются локально, upstream получает IP адрес
+# Имена upstream прокси (если в списке не IP) всегда разрешаются локально
+DNS_MODE = "remote"
+DNS_CACHE_SIZE = 1024       # Максимум записей в кэше (LRU)
+DNS_CACHE_TTL = 300         # Время жизни успешного ответа (секунды)
+DNS_NEGATIVE_TTL = 30       # Время жизни ответа "имя не найдено" (секунды)
+DNS_RESOLVER_THREADS = 2    # Потоки для DNS запросов (отдельно от пула по умолчанию)
+
+# Собственные upstream прокси (например, платные, с аутентификацией RFC 1929)
+# Используются всегда, вместе с прокси из списка и без фильтрации по пингу/стране
+# Пример:
+# PRIVATE_UPSTREAMS = [
+#     {"ip": "203.0.113.10", "port": 1080, "username": "user", "password": "secret", "ping": 50},
+# ]
+PRIVATE_UPSTREAMS = []
+
+# Цепочка прокси: все соединения идут через этот фиксированный первый hop,
+# а выбранный прокси становится вторым hop'ом. None - без цепочки
+# Пример: CHAIN_FIRST_HOP = {"ip": "198.51.100.5", "port": 1080, "username": "u", "password": "p"}
+CHAIN_FIRST_HOP = None
+
+# Отправлять приветствие, аутентификацию и CONNECT всех hop'ов одной записью
+# (экономит сетевые задержки). Отключите, если upstream не принимает такие запросы
+UPSTREAM_PIPELINING = True
+
+# Аутентификация клиентов по логину и паролю (RFC 1929)
+# Позволяет открыть прокси для локальной сети (LOCAL_HOST = "0.0.0.0")
+# Формат USERS_FILE, по одному пользователю в строке:
+#   имя:пароль[:макс. соединений[:лимит КБ/с]]
+# Вместо пароля можно указать хэш sha256$соль_hex$хэш_hex, где хэш = SHA-256(соль + пароль):
+#   python -c "import os,hashlib;s=os.urandom(16);print('sha256$'+s.hex()+'$'+hashlib.sha256(s+b'пароль').hexdigest())"
+# Файл перечитывается автоматически при изменении, перезапуск не нужен
+CLIENT_AUTH = False
+USERS_FILE = "users.txt"
+USERS_RELOAD_INTERVAL = 10  # Как часто проверять изменения файла (секунды)
+USER_MAX_CONNECTIONS = 0    # Одновременных соединений на пользователя по умолчанию (0 - без лимита)
+USER_BANDWIDTH_LIMIT = 0    # Скорость на пользователя по умолчанию, КБ/с (0 - без лимита)
+
+# Ограничение скорости (КБ/с, 0 - без ограничения)
+GLOBAL_BANDWIDTH_LIMIT = 0     # Суммарно для всего прокси
+UPSTREAM_BANDWIDTH_LIMIT = 0   # На каждый upstream прокси
+CLIENT_BANDWIDTH_LIMIT = 0     # На каждый IP адрес клиента
+
+# Приоритет интерактивного трафика при упоре в лимит
+# Непрерывная передача больше BULK_THRESHOLD байт считается bulk (загрузка медиа)
+# и не может использовать последние BULK_RESERVE (доля) токенов лимита,
+# которые остаются сообщениям и другим небольшим передачам
+BULK_THRESHOLD = 1048576
+BULK_RESERVE = 0.25
+
+# UDP ASSOCIATE (голосовые и видеозвонки Telegram)
+# Датаграммы пересылаются через UDP relay текущего upstream прокси.
+# Не работает вместе с CHAIN_FIRST_HOP
+UDP_ENABLED = True
+UDP_IDLE_TIMEOUT = 120  # Закрывать UDP ассоциацию после простоя (секунды)
+
+# HTTP CONNECT прокси для приложений, которые не поддерживают SOCKS5
+# Использует те же upstream прокси, лимиты скорости и пользователей
+# (Proxy-Authorization: Basic при CLIENT_AUTH). Поддерживается только метод CONNECT
+HTTP_CONNECT_ENABLED = False
+HTTP_CONNECT_HOST = "127.0.0.1"
+HTTP_CONNECT_PORT = 8080
+HTTP_MAX_HEADER_SIZE = 8192  # Максимальный размер заголовка запроса (байт)
+
+# Быстрый старт: порты открываются до загрузки списка прокси.
+# Пока список загружается, клиенты идут через прокси, сохраненные при прошлом
+# запуске в UPSTREAM_CACHE_FILE, а если кэша нет - ждут до FAST_START_HOLD секунд.
+# Прокси с логином и паролем (PRIVATE_UPSTREAMS) в кэш не сохраняются.
+# False - как раньше, сначала загрузить и проверить список, затем открыть порты
+FAST_START = True
+FAST_START_HOLD = 5  # Сколько секунд клиент может ждать первый upstream
+UPSTREAM_CACHE_FILE = "upstream_cache.json"  # "" - не сохранять список
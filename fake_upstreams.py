@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Ферма поддельных upstream SOCKS5 прокси для воспроизведения сбоев
+Каждый upstream настраивается задержками, потерями и расписанием отказов
+"""
+
+import asyncio
+import random
+import sys
+import time
+
+# Режимы отказа upstream прокси
+FAILURE_MODES = (
+    "refuse",          # Соединение сразу закрывается (аналог RST)
+    "slow_greeting",   # Ответ на приветствие приходит с большой задержкой
+    "half_open",       # Соединение принято, но ответа нет никогда
+    "connect_error",   # CONNECT отклоняется с ненулевым статусом
+    "reset_mid_relay"  # Соединение обрывается в процессе передачи данных
+)
+
+
+def make_spec(latency=0.0, loss=0.0, schedule=None, ping=100, country="XX",
+              slow_delay=10.0, connect_status=0x05, reset_after=1024):
+    """Описание поведения одного upstream
+
+    latency   - задержка перед каждым ответом handshake (секунды)
+    loss      - вероятность, что соединение "потеряется" (half_open)
+    schedule  - список (начало, длительность, режим) относительно старта фермы;
+                длительность None - до конца работы фермы
+    ping      - пинг, который попадет в список прокси
+    """
+    return {
+        "latency": latency,
+        "loss": loss,
+        "schedule": list(schedule or []),
+        "ping": ping,
+        "country": country,
+        "slow_delay": slow_delay,
+        "connect_status": connect_status,
+        "reset_after": reset_after,
+        # Счетчики, заполняемые во время работы
+        "connections": 0,
+        "healthy_connections": 0,  # Соединения, пришедшие, когда upstream был исправен
+        "relayed": 0,
+        "failed": 0
+    }
+
+
+def current_mode(spec, elapsed):
+    """Возвращает режим отказа, действующий в момент elapsed (None - работает)"""
+    for start, duration, mode in spec["schedule"]:
+        if elapsed >= start and (duration is None or elapsed < start + duration):
+            return mode
+    return None
+
+
+def schedule_failure(farm, index, mode, start=None, duration=None):
+    """Добавляет отказ upstream index (start - секунды от старта, None - сейчас)"""
+    if mode not in FAILURE_MODES:
+        raise ValueError(f"Неизвестный режим отказа: {mode}")
+    if start is None:
+        start = time.monotonic() - farm["started"]
+    farm["specs"][index]["schedule"].append((start, duration, mode))
+
+
+def make_upstream_handler(farm, spec):
+    """Создает обработчик соединений для одного поддельного upstream"""
+
+    async def handle(reader, writer):
+        farm["tasks"].add(asyncio.current_task())
+        spec["connections"] += 1
+        mode = current_mode(spec, time.monotonic() - farm["started"])
+        if mode is None:
+            spec["healthy_connections"] += 1
+            if spec["loss"] and farm["random"].random() < spec["loss"]:
+                mode = "half_open"
+
+        try:
+            if mode == "refuse":
+                spec["failed"] += 1
+                return
+            if mode == "half_open":
+                spec["failed"] += 1
+                await reader.read()  # Молчим, пока клиент не закроет соединение
+                return
+
+            # Приветствие (+ аутентификация, если клиент ее предлагает)
+            greeting = await reader.readexactly(2)
+            methods = await reader.readexactly(greeting[1])
+            if mode == "slow_greeting":
+                await asyncio.sleep(spec["slow_delay"])
+            elif spec["latency"]:
+                await asyncio.sleep(spec["latency"])
+            if 0x02 in methods and 0x00 not in methods:
+                writer.write(b'\x05\x02')
+                header = await reader.readexactly(2)
+                await reader.readexactly(header[1])
+                await reader.readexactly((await reader.readexactly(1))[0])
+                writer.write(b'\x01\x00')
+            else:
+                writer.write(b'\x05\x00')
+
+            # Запрос CONNECT
+            request = await reader.readexactly(4)
+            atyp = request[3]
+            if atyp == 0x01:
+                await reader.readexactly(4 + 2)
+            elif atyp == 0x03:
+                await reader.readexactly((await reader.readexactly(1))[0] + 2)
+            else:
+                await reader.readexactly(16 + 2)
+            if spec["latency"]:
+                await asyncio.sleep(spec["latency"])
+            if mode == "connect_error":
+                spec["failed"] += 1
+                writer.write(bytes([0x05, spec["connect_status"], 0x00, 0x01]) + b'\x00' * 6)
+                await writer.drain()
+                return
+            writer.write(b'\x05\x00\x00\x01' + b'\x00' * 6)
+            await writer.drain()
+
+            # Вместо реального адреса назначения отвечаем эхом
+            relayed = 0
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                if mode == "reset_mid_relay" and relayed + len(data) > spec["reset_after"]:
+                    spec["failed"] += 1
+                    writer.transport.abort()
+                    return
+                relayed += len(data)
+                writer.write(data)
+                await writer.drain()
+            spec["relayed"] += 1
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            farm["tasks"].discard(asyncio.current_task())
+            writer.close()
+
+    return handle
+
+
+async def start_farm(specs, host="127.0.0.1", seed=0):
+    """Запускает по одному поддельному upstream на каждое описание
+
+    seed задает генератор потерь, чтобы прогоны были воспроизводимыми.
+    """
+    farm = {"specs": specs, "servers": [], "proxies": [], "tasks": set(), "started": time.monotonic(),
+            "random": random.Random(seed)}
+    for index, spec in enumerate(specs):
+        server = await asyncio.start_server(make_upstream_handler(farm, spec), host, 0)
+        port = server.sockets[0].getsockname()[1]
+        farm["servers"].append(server)
+        farm["proxies"].append({
+            "ip": host,
+            "port": port,
+            "ping": spec["ping"],
+            "country": spec["country"],
+            "index": index
+        })
+    return farm
+
+
+async def stop_farm(farm):
+    """Останавливает все поддельные upstream и обрывает их соединения"""
+    for server in farm["servers"]:
+        server.close()
+    for task in list(farm["tasks"]):
+        task.cancel()
+    await asyncio.gather(*farm["tasks"], return_exceptions=True)
+    for server in farm["servers"]:
+        await server.wait_closed()
+
+
+def reset_counters(farm):
+    """Обнуляет счетчики соединений (например, после проверки кандидатов)"""
+    for spec in farm["specs"]:
+        spec["connections"] = spec["healthy_connections"] = spec["relayed"] = spec["failed"] = 0
+
+
+async def main():
+    """Запускает ферму как отдельный процесс и сохраняет список прокси в JSON
+
+    Файл можно указать прокси как PROXY_LIST_URL = "file:///путь/к/файлу.json"
+    """
+    import json
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    bad_share = float(sys.argv[2]) if len(sys.argv) > 2 else 0.3
+    output = sys.argv[3] if len(sys.argv) > 3 else "fake_proxies.json"
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+
+    rng = random.Random(seed)
+    specs = []
+    for i in range(count):
+        spec = make_spec(latency=rng.uniform(0.005, 0.05), ping=rng.randint(20, 299))
+        if rng.random() < bad_share:
+            spec["schedule"].append((0, None, rng.choice(FAILURE_MODES)))
+        specs.append(spec)
+
+    farm = await start_farm(specs, seed=seed)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(farm["proxies"], f, indent=2)
+    print(f"Запущено {count} поддельных upstream, список сохранен в {output}")
+    print("Ctrl+C для остановки", flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Сценарии отказов upstream прокси на ферме fake_upstreams.py
+Измеряет время переключения, долю успешных подключений и качество выбора прокси
+"""
+
+import asyncio
+import contextlib
+import io
+import random
+import sys
+import time
+
+import tg_socks5_proxy as proxy
+from fake_upstreams import make_spec, start_farm, stop_farm, schedule_failure, reset_counters
+
+PAYLOAD = b'x' * 2048  # Данные одного запроса клиента (больше reset_after по умолчанию)
+
+
+def reset_proxy_state():
+    """Сбрасывает глобальное состояние прокси между сценариями"""
+    proxy.current_proxy = None
+    proxy.proxy_list = []
+    proxy.proxy_blacklist.clear()
+    proxy.upstream_stats.clear()
+    proxy.client_assignments.clear()
+    proxy.client_active.clear()
+    proxy.routing = proxy.RoutingSnapshot(0, None, (), 0)
+    proxy.connection_errors = 0
+    proxy.last_proxy_switch = 0
+    proxy.successful_connections = 0
+    proxy.total_connections = 0
+
+    # Сжимаем таймауты, чтобы сценарии занимали секунды, а не минуты
+    proxy.CONNECTION_TIMEOUT = 1
+    proxy.SOCKS_TIMEOUT = 1
+    proxy.QUALIFY_TIMEOUT = 1
+    proxy.MIN_SWITCH_INTERVAL = 1
+    proxy.UPSTREAM_CACHE_FILE = ""  # Не перезаписываем кэш быстрого старта
+
+
+async def client_request(port):
+    """Один запрос клиента: handshake, CONNECT и эхо PAYLOAD"""
+    writer = None
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'\x05\x01\x00' + b'\x05\x01\x00\x03\x10api.telegram.org\x01\xbb')
+        await writer.drain()
+        if await reader.readexactly(2) != b'\x05\x00':
+            return False
+        reply = await reader.readexactly(10)
+        if reply[1] != 0x00:
+            return False
+        writer.write(PAYLOAD)
+        await writer.drain()
+        return await reader.readexactly(len(PAYLOAD)) == PAYLOAD
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return False
+    finally:
+        if writer:
+            writer.close()
+
+
+async def client_worker(port, results, stop_at, interval):
+    """Генерирует запросы до stop_at и записывает (время, успех, задержка)"""
+    while time.monotonic() < stop_at:
+        started = time.monotonic()
+        try:
+            ok = await asyncio.wait_for(client_request(port), timeout=3)
+        except asyncio.TimeoutError:
+            ok = False
+        results.append((started, ok, time.monotonic() - started))
+        await asyncio.sleep(interval)
+
+
+async def inject_failures(farm, failures, started, injected):
+    """Выполняет отказы по расписанию: (через сколько секунд, индекс или "current", режим)"""
+    for at, target, mode in sorted(failures, key=lambda f: f[0]):
+        await asyncio.sleep(max(0, started + at - time.monotonic()))
+        if target == "current":
+            target = proxy.current_proxy["index"]
+        schedule_failure(farm, target, mode)
+        injected.append((time.monotonic(), target))
+
+
+async def run_scenario(name, specs, duration=8, clients=8, interval=0.05,
+                       failures=(), qualify=False, striping=False, seed=42):
+    """Запускает сценарий и возвращает словарь с метриками"""
+    reset_proxy_state()
+    proxy.STRIPING_ENABLED = striping
+    random.seed(seed)  # Прокси выбирает upstream через модуль random
+
+    farm = await start_farm(specs, seed=seed)
+    server = None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            if qualify:
+                first_ready = asyncio.Event()
+                asyncio.ensure_future(proxy.qualify_proxy_list(list(farm["proxies"]), first_ready))
+                await first_ready.wait()
+            else:
+                proxy.proxy_list = list(farm["proxies"])
+            proxy.select_random_proxy()
+
+            reset_counters(farm)
+            server = await asyncio.start_server(proxy.handle_socks5_client, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+
+            results = []
+            injected = []
+            started = time.monotonic()
+            stop_at = started + duration
+            await asyncio.gather(
+                inject_failures(farm, failures, started, injected),
+                *(client_worker(port, results, stop_at, interval) for _ in range(clients))
+            )
+    finally:
+        if server:
+            server.close()
+        await stop_farm(farm)
+        await asyncio.sleep(0.1)  # Даем прокси закрыть оборванные соединения
+
+    ok = [r for r in results if r[1]]
+    latencies = sorted(r[2] for r in ok)
+
+    # Время переключения: от отказа до первого успешного запроса после него
+    failover_time = None
+    if injected:
+        failed_at = injected[0][0]
+        after = [r[0] + r[2] for r in ok if r[0] >= failed_at]
+        failover_time = min(after) - failed_at if after else None
+
+    # Качество выбора: доля соединений, отправленных на исправный в тот момент upstream
+    sent_total = sum(spec["connections"] for spec in specs)
+    sent_healthy = sum(spec["healthy_connections"] for spec in specs if not spec["loss"])
+
+    return {
+        "name": name,
+        "upstreams": len(specs),
+        "requests": len(results),
+        "success_rate": len(ok) / len(results) * 100 if results else 0.0,
+        "failover_time": failover_time,
+        "p50_ms": proxy.percentile(latencies, 50) * 1000,
+        "p95_ms": proxy.percentile(latencies, 95) * 1000,
+        "selection_quality": sent_healthy / sent_total * 100 if sent_total else 0.0,
+        "blacklisted": len(proxy.proxy_blacklist)
+    }
+
+
+def mixed_farm(count, bad_share=0.3, loss=0.05):
+    """Ферма, где часть upstream сломана с самого начала, а часть теряет соединения"""
+    rng = random.Random(42)  # Детерминированный набор отказов
+    specs = []
+    for _ in range(count):
+        spec = make_spec(latency=rng.uniform(0.002, 0.03), ping=rng.randint(20, 299))
+        roll = rng.random()
+        if roll < bad_share:
+            spec["schedule"].append((0, None, rng.choice(
+                ("refuse", "half_open", "connect_error", "slow_greeting"))))
+        elif roll < bad_share + loss:
+            spec["loss"] = 0.5
+        specs.append(spec)
+    return specs
+
+
+def healthy_farm(count):
+    """Ферма исправных upstream"""
+    return [make_spec(latency=0.01, ping=50) for _ in range(count)]
+
+
+async def run_all(farm_size):
+    """Прогоняет все сценарии"""
+    scenarios = [
+        ("Исправная ферма", healthy_farm(20), {}),
+        ("RST текущего прокси", healthy_farm(20), {"failures": [(2, "current", "refuse")]}),
+        ("Half-open текущего прокси", healthy_farm(20), {"failures": [(2, "current", "half_open")]}),
+        ("CONNECT со статусом 0x05", healthy_farm(20), {"failures": [(2, "current", "connect_error")]}),
+        ("Медленное приветствие", healthy_farm(20), {"failures": [(2, "current", "slow_greeting")]}),
+        ("Обрыв во время передачи", healthy_farm(20), {"failures": [(2, "current", "reset_mid_relay")]}),
+        ("Смешанная ферма без проверки", mixed_farm(farm_size), {}),
+        ("Смешанная ферма с проверкой", mixed_farm(farm_size), {"qualify": True}),
+        ("Смешанная ферма, striping", mixed_farm(farm_size), {"qualify": True, "striping": True}),
+    ]
+
+    reports = []
+    for name, specs, options in scenarios:
+        print(f"▶ {name} ({len(specs)} upstream)...", flush=True)
+        reports.append(await run_scenario(name, specs, **options))
+    return reports
+
+
+def print_report(reports):
+    """Печатает таблицу с результатами сценариев"""
+    print("-" * 100)
+    print(f"{'Сценарий':<32} {'Запросов':>8} {'Успех':>8} {'Failover':>10} "
+          f"{'p50':>8} {'p95':>8} {'Качество':>9} {'Blacklist':>9}")
+    print("-" * 100)
+    for r in reports:
+        failover = f"{r['failover_time']:.2f}с" if r["failover_time"] is not None else "—"
+        print(f"{r['name']:<32} {r['requests']:>8} {r['success_rate']:>7.1f}% {failover:>10} "
+              f"{r['p50_ms']:>6.1f}ms {r['p95_ms']:>6.1f}ms {r['selection_quality']:>8.1f}% "
+              f"{r['blacklisted']:>9}")
+    print("-" * 100)
+    print("Failover - время от отказа до первого успешного запроса после него")
+    print("Качество - доля соединений, отправленных на исправный в тот момент upstream")
+
+
+def main():
+    """Главная функция"""
+    print("=" * 60)
+    print("Сценарии отказов upstream прокси")
+    print("=" * 60)
+
+    farm_size = 200
+    if len(sys.argv) > 1:
+        try:
+            farm_size = int(sys.argv[1])
+        except ValueError:
+            print("ОШИБКА: размер фермы должен быть числом")
+            sys.exit(1)
+
+    reports = asyncio.run(run_all(farm_size))
+    print_report(reports)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nТест прерван пользователем")
+        sys.exit(1)
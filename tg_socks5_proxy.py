@@ -4,14 +4,21 @@ Telegram SOCKS5 Proxy
 Автоматически подключается к прокси с пингом < 300 из списка
 """
 
+import time
+
+PROCESS_STARTED = time.monotonic()  # Для замера времени до первого принятого соединения
+
+# Редко нужные модули (json, urllib, hashlib, hmac, base64, traceback) импортируются
+# в функциях, которые их используют, чтобы не задерживать открытие портов
 import asyncio
 import socket
-import json
+import ipaddress
+import os
 import random
-import time
+import signal
 import sys
-from urllib.request import urlopen
-from urllib.error import URLError
+import threading
+from collections import deque, namedtuple, OrderedDict
 
 # Импортируем конфигурацию
 try:
@@ -21,8 +28,13 @@ try:
         CLIENT_TIMEOUT, SOCKS_TIMEOUT, VERBOSE,
         ALLOWED_COUNTRIES, EXCLUDED_COUNTRIES, MIN_PROXY_AGE
     )
-except ImportError:
+    import config as user_config
+    config_error = None
+except ImportError as e:
     # Значения по умолчанию, если config.py отсутствует
+    user_config = None
+    # Если config.py есть, но в нем нет обязательной настройки - сообщим при запуске
+    config_error = None if isinstance(e, ModuleNotFoundError) and e.name == "config" else e
     PROXY_LIST_URL = "https://raw.githubusercontent.com/hookzof/socks5_list/refs/heads/master/tg/socks.json"
     MAX_PING = 300
     LOCAL_HOST = "127.0.0.1"
@@ -37,6 +49,71 @@ except ImportError:
     EXCLUDED_COUNTRIES = []
     MIN_PROXY_AGE = 0
 
+# Настройки, появившиеся позже: в config.py от старой версии их может не быть,
+# тогда берется значение по умолчанию, а остальные настройки пользователя сохраняются
+missing_settings = []  # Настройки, которых нет в config.py (выводятся при запуске)
+
+
+def config_value(name, default):
+    """Возвращает настройку из config.py или значение по умолчанию"""
+    if hasattr(user_config, name):
+        return getattr(user_config, name)
+    if user_config is not None:
+        missing_settings.append(name)
+    return default
+
+
+LOOP_MONITOR = config_value("LOOP_MONITOR", True)
+LOOP_LAG_INTERVAL = config_value("LOOP_LAG_INTERVAL", 0.25)
+LOOP_LAG_WINDOW = config_value("LOOP_LAG_WINDOW", 2400)
+SLOW_CALLBACK_THRESHOLD = config_value("SLOW_CALLBACK_THRESHOLD", 0.1)
+SLOW_CALLBACK_HISTORY = config_value("SLOW_CALLBACK_HISTORY", 20)
+STRIPING_ENABLED = config_value("STRIPING_ENABLED", False)
+STRIPING_TOP_K = config_value("STRIPING_TOP_K", 3)
+STRIPING_STICKY_TTL = config_value("STRIPING_STICKY_TTL", 600)
+THROUGHPUT_INTERVAL = config_value("THROUGHPUT_INTERVAL", 10)
+QUALIFY_ENABLED = config_value("QUALIFY_ENABLED", True)
+QUALIFY_CONCURRENCY = config_value("QUALIFY_CONCURRENCY", 50)
+QUALIFY_TIMEOUT = config_value("QUALIFY_TIMEOUT", 5)
+QUALIFY_TARGET_HOST = config_value("QUALIFY_TARGET_HOST", "149.154.167.51")
+QUALIFY_TARGET_PORT = config_value("QUALIFY_TARGET_PORT", 443)
+HANDOVER_TIMEOUT = config_value("HANDOVER_TIMEOUT", 30)
+DRAIN_TIMEOUT = config_value("DRAIN_TIMEOUT", 300)
+DNS_MODE = config_value("DNS_MODE", "remote")
+DNS_CACHE_SIZE = config_value("DNS_CACHE_SIZE", 1024)
+DNS_CACHE_TTL = config_value("DNS_CACHE_TTL", 300)
+DNS_NEGATIVE_TTL = config_value("DNS_NEGATIVE_TTL", 30)
+DNS_RESOLVER_THREADS = config_value("DNS_RESOLVER_THREADS", 2)
+PRIVATE_UPSTREAMS = config_value("PRIVATE_UPSTREAMS", [])
+CHAIN_FIRST_HOP = config_value("CHAIN_FIRST_HOP", None)
+UPSTREAM_PIPELINING = config_value("UPSTREAM_PIPELINING", True)
+CLIENT_AUTH = config_value("CLIENT_AUTH", False)
+USERS_FILE = config_value("USERS_FILE", "users.txt")
+USERS_RELOAD_INTERVAL = config_value("USERS_RELOAD_INTERVAL", 10)
+USER_MAX_CONNECTIONS = config_value("USER_MAX_CONNECTIONS", 0)
+USER_BANDWIDTH_LIMIT = config_value("USER_BANDWIDTH_LIMIT", 0)
+GLOBAL_BANDWIDTH_LIMIT = config_value("GLOBAL_BANDWIDTH_LIMIT", 0)
+UPSTREAM_BANDWIDTH_LIMIT = config_value("UPSTREAM_BANDWIDTH_LIMIT", 0)
+CLIENT_BANDWIDTH_LIMIT = config_value("CLIENT_BANDWIDTH_LIMIT", 0)
+BULK_THRESHOLD = config_value("BULK_THRESHOLD", 1048576)
+BULK_RESERVE = config_value("BULK_RESERVE", 0.25)
+UDP_ENABLED = config_value("UDP_ENABLED", True)
+UDP_IDLE_TIMEOUT = config_value("UDP_IDLE_TIMEOUT", 120)
+HTTP_CONNECT_ENABLED = config_value("HTTP_CONNECT_ENABLED", False)
+HTTP_CONNECT_HOST = config_value("HTTP_CONNECT_HOST", "127.0.0.1")
+HTTP_CONNECT_PORT = config_value("HTTP_CONNECT_PORT", 8080)
+HTTP_MAX_HEADER_SIZE = config_value("HTTP_MAX_HEADER_SIZE", 8192)
+FAST_START = config_value("FAST_START", True)
+FAST_START_HOLD = config_value("FAST_START_HOLD", 5)
+UPSTREAM_CACHE_FILE = config_value("UPSTREAM_CACHE_FILE", "upstream_cache.json")
+MAX_CONNECTION_ERRORS = config_value("MAX_CONNECTION_ERRORS", 3)
+MIN_SWITCH_INTERVAL = config_value("MIN_SWITCH_INTERVAL", 30)
+
+# Снимок маршрутизации: публикуется control plane, читается data plane без блокировок.
+# Снимок никогда не изменяется - control plane каждый раз создает новый и заменяет
+# ссылку routing одним присваиванием
+RoutingSnapshot = namedtuple("RoutingSnapshot", ["version", "current", "top", "published"])
+
 # Глобальные переменные
 current_proxy = None
 proxy_list = []
@@ -46,6 +123,53 @@ last_proxy_switch = 0  # Время последней смены прокси
 invalid_socks_count = 0  # Счетчик неверных SOCKS подключений
 successful_connections = 0  # Счетчик успешных подключений
 total_connections = 0  # Общее количество попыток подключений
+loop_lag_samples = deque(maxlen=LOOP_LAG_WINDOW)  # Задержки event loop (секунды)
+slow_callbacks = deque(maxlen=SLOW_CALLBACK_HISTORY)  # Последние медленные callback'и
+slow_callback_count = 0  # Всего обнаружено блокировок event loop
+upstream_stats = {}  # Статистика по каждому upstream прокси ("ip:port" -> dict)
+routing = RoutingSnapshot(0, None, (), 0)  # Текущий снимок маршрутизации
+control_loop = None  # Event loop потока control plane (None - не запущен)
+client_assignments = {}  # Sticky-привязки: client_ip -> {dest_addr: (proxy_key, время)}
+client_active = {}  # Активные соединения: (client_ip, proxy_key) -> количество
+throughput = {  # Последний замер пропускной способности
+    "mode": "striping" if STRIPING_ENABLED else "single",
+    "aggregate_bps": 0,
+    "best_single_bps": 0,  # Самый загруженный upstream в том же окне замера
+    "upstreams_used": 0,
+    "peak_aggregate_bps": 0,
+    "peak_busiest_bps": 0  # Самый загруженный upstream в окне пиковой суммарной скорости
+}
+active_clients = 0  # Клиентские соединения в обработке (для плавной остановки)
+listeners = {}  # Запущенные серверы: имя -> asyncio.Server
+shutdown_event = None  # Устанавливается, когда процесс должен завершиться
+handover_in_progress = False  # Идет передача слушающих сокетов новому процессу
+dns_cache = OrderedDict()  # LRU кэш DNS: имя -> (адрес или None, время истечения)
+dns_inflight = {}  # Выполняющиеся запросы: имя -> asyncio.Task (общие для всех ожидающих)
+dns_executor = None  # Отдельный пул потоков для getaddrinfo
+dns_stats = {"hits": 0, "misses": 0, "coalesced": 0, "failures": 0}
+users = {}  # Индекс пользователей: имя -> {"salt", "hash", "max_connections", "bucket"}
+users_file_mtime = None  # Время изменения загруженного файла пользователей
+user_active = {}  # Активные соединения пользователей: имя -> количество
+auth_failures = 0  # Неудачные попытки аутентификации
+rate_buckets = {}  # Лимиты скорости: ("global",) / ("upstream", ключ) / ("client", ip) -> bucket
+udp_stats = {"associations": 0, "active": 0, "datagrams": 0, "bytes": 0, "dropped": 0}
+shaping_stats = {"throttled": 0, "throttled_time": 0.0}  # Сколько раз и сколько секунд ждали лимитов
+startup = {  # Замеры запуска (секунды от старта процесса)
+    "mode": "fast" if FAST_START else "blocking",
+    "source": None,  # Откуда взят первый upstream: state / cache / download
+    "listening_s": None,
+    "first_upstream_s": None,
+    "first_accept_s": None
+}
+qualify_task = None  # Выполняющаяся проверка кандидатов (asyncio.Task)
+qualification = {  # Прогресс проверки кандидатов из нового списка
+    "running": False,
+    "total": 0,
+    "checked": 0,
+    "passed": 0,
+    "first_ready_s": None,
+    "duration_s": None
+}
 
 
 def print_info(msg):
@@ -60,10 +184,12 @@ def print_error(msg):
     print(f"[{timestamp}] ERROR: {msg}", file=sys.stderr, flush=True)
 
 
-def load_proxy_list():
-    """Загружает список прокси из JSON"""
-    global proxy_list
-    
+def fetch_proxy_candidates():
+    """Загружает список прокси из JSON и возвращает отфильтрованных кандидатов"""
+    import json
+    from urllib.request import urlopen
+    from urllib.error import URLError
+
     try:
         print_info(f"Загрузка списка прокси из {PROXY_LIST_URL}...")
         with urlopen(PROXY_LIST_URL, timeout=10) as response:
@@ -89,20 +215,77 @@ def load_proxy_list():
             filtered = [p for p in filtered 
                        if current_time - p.get('addTime', current_time) >= MIN_PROXY_AGE]
         
+        # Собственные (платные) прокси используются всегда, без фильтров
+        filtered = list(PRIVATE_UPSTREAMS) + filtered
+        
         if filtered:
-            proxy_list = filtered
             msg = f"Загружено {len(filtered)} прокси (из {total_count} всего)"
             if ALLOWED_COUNTRIES:
                 msg += f" для стран: {', '.join(ALLOWED_COUNTRIES)}"
             print_info(msg)
-            return True
+            return filtered
         else:
             print_error(f"Не найдено подходящих прокси")
-            return False
+            return None
             
     except (URLError, json.JSONDecodeError) as e:
         print_error(f"Ошибка загрузки списка прокси: {e}")
+        if PRIVATE_UPSTREAMS:
+            print_info(f"Используем только собственные прокси ({len(PRIVATE_UPSTREAMS)})")
+            return list(PRIVATE_UPSTREAMS)
+        return None
+
+
+def load_proxy_list():
+    """Загружает список прокси из JSON без проверки кандидатов"""
+    global proxy_list
+    
+    candidates = fetch_proxy_candidates()
+    if candidates:
+        proxy_list = candidates
+        save_upstream_cache()
+        return True
+    return False
+
+
+def save_upstream_cache():
+    """Сохраняет рабочий список прокси для быстрого старта"""
+    import json
+
+    if not UPSTREAM_CACHE_FILE:
+        return
+    # Прокси с учетными данными (PRIVATE_UPSTREAMS) берутся из config.py и в кэш не пишутся
+    public = [p for p in proxy_list if not p.get('username')]
+    try:
+        fd = os.open(UPSTREAM_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(public, f)
+    except OSError as e:
+        print_error(f"Не удалось сохранить {UPSTREAM_CACHE_FILE}: {e}")
+
+
+def load_upstream_cache():
+    """Загружает список прокси, сохраненный при прошлом запуске"""
+    import json
+    global proxy_list
+
+    if not UPSTREAM_CACHE_FILE:
+        return False
+    try:
+        with open(UPSTREAM_CACHE_FILE, encoding="utf-8") as f:
+            cached = json.load(f)
+    except FileNotFoundError:
         return False
+    except (OSError, ValueError) as e:
+        print_error(f"Не удалось прочитать {UPSTREAM_CACHE_FILE}: {e}")
+        return False
+    # Учетные данные из старого кэша не используем - собственные прокси берем из конфига
+    cached = [p for p in cached if not p.get('username')]
+    if not cached and not PRIVATE_UPSTREAMS:
+        return False
+    proxy_list = list(PRIVATE_UPSTREAMS) + cached
+    print_info(f"Загружено {len(proxy_list)} прокси из {UPSTREAM_CACHE_FILE}")
+    return True
 
 
 def select_random_proxy():
@@ -127,6 +310,7 @@ def select_random_proxy():
     current_proxy = proxy
     last_proxy_switch = time.time()
     connection_errors = 0
+    publish_routing()
     
     print_info(f"Выбран прокси: {proxy['ip']}:{proxy['port']} "
                f"(страна: {proxy.get('country', 'N/A')}, пинг: {proxy.get('ping', 'N/A')}ms, "
@@ -144,6 +328,7 @@ def add_to_blacklist(proxy_ip, proxy_port, reason="неизвестно"):
     proxy_key = f"{proxy_ip}:{proxy_port}"
     if proxy_key not in proxy_blacklist:
         proxy_blacklist.add(proxy_key)
+        publish_routing()
         print_error(f"Прокси {proxy_key} добавлен в blacklist ({reason})")
 
 
@@ -151,44 +336,268 @@ def should_switch_proxy():
     """Проверяет, нужно ли переключиться на другой прокси"""
     global connection_errors, last_proxy_switch
     
-    MAX_ERRORS = 3  # Максимум ошибок до смены прокси
-    MIN_SWITCH_INTERVAL = 30  # Минимальный интервал между сменами (секунды)
-    
-    if connection_errors >= MAX_ERRORS:
+    if connection_errors >= MAX_CONNECTION_ERRORS:
         time_since_switch = time.time() - last_proxy_switch
         if time_since_switch >= MIN_SWITCH_INTERVAL:
             return True
     return False
 
 
-async def connect_to_upstream(proxy_ip, proxy_port, dest_host, dest_port):
-    """Подключается к upstream SOCKS5 прокси"""
+def proxy_key_of(proxy):
+    """Возвращает ключ прокси вида ip:port"""
+    return f"{proxy['ip']}:{proxy['port']}"
+
+
+def current_proxy_listed():
+    """Проверяет, остался ли текущий прокси в proxy_list (после обновления списка)"""
+    if current_proxy is None:
+        return False
+    key = proxy_key_of(current_proxy)
+    return any(proxy_key_of(p) == key for p in proxy_list)
+
+
+def get_upstream_stats(proxy):
+    """Возвращает (создавая при необходимости) статистику upstream прокси"""
+    key = proxy_key_of(proxy)
+    stats = upstream_stats.get(key)
+    if stats is None:
+        stats = upstream_stats[key] = {
+            "successes": 0,
+            "failures": 0,
+            "consecutive_failures": 0,
+            "connect_time": proxy.get('ping', MAX_PING) / 1000,  # EWMA, секунды
+            "bytes": 0,
+            "active": 0
+        }
+    return stats
+
+
+def record_upstream_result(proxy, ok, connect_time=None):
+    """Учитывает результат подключения через upstream прокси"""
+    stats = get_upstream_stats(proxy)
+    if ok:
+        stats["successes"] += 1
+        stats["consecutive_failures"] = 0
+        if connect_time is not None:
+            stats["connect_time"] = stats["connect_time"] * 0.8 + connect_time * 0.2
+    else:
+        stats["failures"] += 1
+        stats["consecutive_failures"] += 1
+    return stats
+
+
+def upstream_health_key(proxy):
+    """Ключ сортировки прокси: сначала доля успехов, затем время подключения"""
+    stats = upstream_stats.get(proxy_key_of(proxy))
+    if stats is None:
+        return (-0.5, proxy.get('ping', MAX_PING) / 1000)
+    success_rate = (stats["successes"] + 1) / (stats["successes"] + stats["failures"] + 2)
+    return (-success_rate, stats["connect_time"])
+
+
+def get_top_upstreams(k):
+    """Возвращает top-K самых здоровых прокси"""
+    available = [p for p in proxy_list if proxy_key_of(p) not in proxy_blacklist]
+    top = sorted(available, key=upstream_health_key)[:k]
+    if current_proxy in available and current_proxy not in top:
+        # Текущий прокси всегда участвует, чтобы striping был не хуже single-режима
+        top = top[:k - 1] + [current_proxy]
+    return top
+
+
+def publish_routing():
+    """Публикует новый снимок маршрутизации (выполняется в control plane)"""
+    global routing
+    top = ()
+    if STRIPING_ENABLED and STRIPING_TOP_K >= 2:
+        top = tuple(get_top_upstreams(STRIPING_TOP_K))
+    routing = RoutingSnapshot(routing.version + 1, current_proxy, top, time.time())
+    if current_proxy and startup["first_upstream_s"] is None:
+        startup["first_upstream_s"] = round(time.monotonic() - PROCESS_STARTED, 3)
+
+
+async def wait_for_upstream():
+    """Ждет первый upstream после быстрого старта (не дольше FAST_START_HOLD секунд)"""
+    deadline = time.monotonic() + FAST_START_HOLD
+    while routing.current is None and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    return routing.current
+
+
+def select_upstream_for_client(client_ip, dest_addr):
+    """Выбирает upstream для соединения клиента (striping по top-K прокси)"""
+    snapshot = routing  # Одно чтение ссылки - дальше работаем с неизменяемым снимком
+    top = snapshot.top
+    if not top:
+        return snapshot.current
+
+    now = time.monotonic()
+    assignments = client_assignments.setdefault(client_ip, {})
+
+    # Sticky-привязка: соединения к одному DC идут через один upstream
+    sticky = assignments.get(dest_addr)
+    if sticky and now - sticky[1] < STRIPING_STICKY_TTL:
+        for proxy in top:
+            if proxy_key_of(proxy) == sticky[0]:
+                assignments[dest_addr] = (sticky[0], now)
+                return proxy
+
+    # Новый DC - берем upstream с наименьшим числом соединений этого клиента
+    proxy = min(top, key=lambda p: client_active.get((client_ip, proxy_key_of(p)), 0))
+    assignments[dest_addr] = (proxy_key_of(proxy), now)
+
+    # Удаляем устаревшие привязки
+    for addr, (_, used) in list(assignments.items()):
+        if now - used >= STRIPING_STICKY_TTL:
+            del assignments[addr]
+    return proxy
+
+
+def report_upstream_failure(proxy, error):
+    """Учитывает ошибку подключения через upstream: blacklist и смена прокси
+
+    Выполняется в control plane; статистику upstream data plane обновляет сам.
+    """
+    global connection_errors
+
+    if proxy is not current_proxy:
+        # Ошибка дополнительного upstream в режиме striping
+        stats = upstream_stats.get(proxy_key_of(proxy))
+        if stats and stats["consecutive_failures"] >= MAX_CONNECTION_ERRORS:
+            add_to_blacklist(proxy['ip'], proxy['port'], "множественные ошибки подключения")
+        return
+    connection_errors += 1
+
+    # Добавляем прокси в blacklist если он явно не работает
+    if connection_errors % MAX_CONNECTION_ERRORS == 0:  # Логируем каждую N-ю ошибку
+        print_error(f"Ошибка подключения к upstream ({connection_errors}): {error}")
+
+    if connection_errors >= MAX_CONNECTION_ERRORS:
+        add_to_blacklist(proxy['ip'], proxy['port'], "множественные ошибки подключения")
+
+    # Проверяем, нужно ли переключиться на другой прокси
+    if should_switch_proxy():
+        print_info("Слишком много ошибок, переключаемся на другой прокси...")
+        select_random_proxy()
+
+
+def is_ip_address(host):
+    """Проверяет, является ли строка IPv4/IPv6 адресом"""
     try:
-        # Подключаемся к upstream SOCKS5 прокси
-        reader, writer = await asyncio.wait_for(
-            asyncio.open_connection(proxy_ip, proxy_port),
-            timeout=CONNECTION_TIMEOUT
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+def encode_socks_address(host):
+    """Кодирует адрес для SOCKS5 запроса: ATYP + адрес"""
+    try:
+        addr = ipaddress.ip_address(host)
+    except ValueError:
+        encoded = host.encode()
+        if len(encoded) > 255:
+            raise ValueError(f"имя хоста длиннее 255 байт: {host[:32]}...")
+        return b'\x03' + bytes([len(encoded)]) + encoded
+    if addr.version == 4:
+        return b'\x01' + addr.packed
+    return b'\x04' + addr.packed
+
+
+async def query_dns(host):
+    """Выполняет DNS запрос в отдельном пуле потоков (None - имя не найдено)"""
+    global dns_executor
+
+    if dns_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        dns_executor = ThreadPoolExecutor(max_workers=DNS_RESOLVER_THREADS, thread_name_prefix="dns")
+
+    loop = asyncio.get_running_loop()
+    try:
+        infos = await loop.run_in_executor(
+            dns_executor, socket.getaddrinfo, host, None, 0, socket.SOCK_STREAM
         )
-        
-        # SOCKS5 приветствие
-        writer.write(b'\x05\x01\x00')  # VER=5, NMETHODS=1, METHOD=0 (no auth)
-        await writer.drain()
-        
-        # Читаем ответ
+    except (OSError, UnicodeError):
+        return None
+    return infos[0][4][0]
+
+
+async def lookup_host(host):
+    """Выполняет DNS запрос и кэширует результат"""
+    try:
+        address = await query_dns(host)
+    finally:
+        dns_inflight.pop(host, None)
+
+    if address is None:
+        dns_stats["failures"] += 1
+        ttl = DNS_NEGATIVE_TTL  # Негативное кэширование
+    else:
+        ttl = DNS_CACHE_TTL
+
+    dns_cache[host] = (address, time.monotonic() + ttl)
+    dns_cache.move_to_end(host)
+    while len(dns_cache) > DNS_CACHE_SIZE:
+        dns_cache.popitem(last=False)
+    return address
+
+
+async def resolve_host(host):
+    """Разрешает имя в IP адрес через кэш (None - имя не найдено)"""
+    if is_ip_address(host):
+        return host
+    if control_loop is not None and asyncio.get_running_loop() is control_loop:
+        # Кэш и общие запросы принадлежат data plane; проверка кандидатов
+        # в control plane разрешает имена без них
+        return await query_dns(host)
+
+    entry = dns_cache.get(host)
+    if entry and entry[1] > time.monotonic():
+        dns_stats["hits"] += 1
+        dns_cache.move_to_end(host)
+        return entry[0]
+
+    # Одновременные запросы одного имени ждут один общий запрос
+    task = dns_inflight.get(host)
+    if task is None:
+        dns_stats["misses"] += 1
+        task = dns_inflight[host] = asyncio.ensure_future(lookup_host(host))
+    else:
+        dns_stats["coalesced"] += 1
+    return await asyncio.shield(task)
+
+
+def build_socks_handshake(hop, dest_host, dest_port, command=0x01):
+    """Формирует приветствие, аутентификацию (RFC 1929) и запрос для одного hop"""
+    username = hop.get('username')
+    if username:
+        password = hop.get('password', '').encode()
+        username = username.encode()
+        greeting = b'\x05\x01\x02'  # VER=5, NMETHODS=1, METHOD=2 (username/password)
+        auth = b'\x01' + bytes([len(username)]) + username + bytes([len(password)]) + password
+    else:
+        greeting = b'\x05\x01\x00'  # VER=5, NMETHODS=1, METHOD=0 (no auth)
+        auth = b''
+    # VER=5, CMD (1 - CONNECT, 3 - UDP ASSOCIATE), RSV=0, ATYP по типу адреса
+    request = bytes([0x05, command, 0x00]) + encode_socks_address(dest_host) + dest_port.to_bytes(2, 'big')
+    return greeting, auth, request
+
+
+async def read_socks_reply(reader, stage, hop):
+    """Читает ответ upstream на этап handshake (greeting/auth/connect)
+
+    Для этапа connect возвращает адрес и порт из ответа (BND.ADDR, BND.PORT).
+    """
+    if stage == "greeting":
         response = await asyncio.wait_for(reader.readexactly(2), timeout=SOCKS_TIMEOUT)
-        if response != b'\x05\x00':
+        expected = b'\x05\x02' if hop.get('username') else b'\x05\x00'
+        if response != expected:
             raise Exception(f"SOCKS5 handshake failed: {response.hex()}")
-        
-        # Отправляем запрос на подключение
-        # VER=5, CMD=1 (CONNECT), RSV=0, ATYP=3 (domain name)
-        request = b'\x05\x01\x00\x03'
-        request += bytes([len(dest_host)]) + dest_host.encode()
-        request += dest_port.to_bytes(2, 'big')
-        
-        writer.write(request)
-        await writer.drain()
-        
-        # Читаем ответ
+    elif stage == "auth":
+        response = await asyncio.wait_for(reader.readexactly(2), timeout=SOCKS_TIMEOUT)
+        if response[1] != 0x00:
+            raise Exception(f"SOCKS5 auth failed, status: {response[1]}")
+    else:
         response = await asyncio.wait_for(reader.readexactly(4), timeout=SOCKS_TIMEOUT)
         if response[1] != 0x00:
             raise Exception(f"SOCKS5 connect failed, status: {response[1]}")
@@ -196,23 +605,722 @@ async def connect_to_upstream(proxy_ip, proxy_port, dest_host, dest_port):
         # Читаем остаток ответа (адрес и порт)
         atyp = response[3]
         if atyp == 0x01:  # IPv4
-            await reader.readexactly(6)
+            bound = socket.inet_ntoa(await reader.readexactly(4))
         elif atyp == 0x03:  # Domain
             addr_len = (await reader.readexactly(1))[0]
-            await reader.readexactly(addr_len + 2)
+            bound = (await reader.readexactly(addr_len)).decode()
         elif atyp == 0x04:  # IPv6
-            await reader.readexactly(18)
-        
+            bound = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+        else:
+            raise Exception(f"SOCKS5 connect failed, unknown ATYP: {atyp}")
+        return bound, int.from_bytes(await reader.readexactly(2), 'big')
+
+
+def record_hop_time(hop, seconds):
+    """Учитывает время handshake через hop (EWMA)"""
+    stats = get_upstream_stats(hop)
+    previous = stats.get("handshake_time")
+    stats["handshake_time"] = seconds if previous is None else previous * 0.8 + seconds * 0.2
+
+
+def build_handshake_stages(hops, dest_host, dest_port, command=0x01):
+    """Собирает этапы handshake по цепочке hop'ов: список (hop, этап, данные)
+
+    Каждый hop подключается к следующему, последний выполняет command для адреса назначения.
+    """
+    targets = [(hop['ip'], hop['port']) for hop in hops[1:]] + [(dest_host, dest_port)]
+    stages = []
+    for index, (hop, (host, port)) in enumerate(zip(hops, targets)):
+        last = index == len(hops) - 1
+        greeting, auth, request = build_socks_handshake(hop, host, port, command if last else 0x01)
+        stages.append((hop, "greeting", greeting))
+        if auth:
+            stages.append((hop, "auth", auth))
+        stages.append((hop, "connect", request))
+    return stages
+
+
+async def open_socks_connection(first_hop, stages):
+    """Подключается к первому hop и выполняет этапы handshake
+
+    Возвращает reader, writer и адрес из ответа последнего hop (BND.ADDR, BND.PORT).
+    При ошибке соединение закрывается.
+    """
+    proxy_addr = await asyncio.wait_for(resolve_host(first_hop['ip']), timeout=CONNECTION_TIMEOUT)
+    if proxy_addr is None:
+        raise Exception(f"DNS: не удалось разрешить {first_hop['ip']}")
+
+    started = time.monotonic()
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(proxy_addr, first_hop['port']),
+        timeout=CONNECTION_TIMEOUT
+    )
+    try:
+        if UPSTREAM_PIPELINING:
+            # Метод предлагается один, поэтому ответ известен заранее - отправляем
+            # все этапы всех hop'ов одной записью и затем читаем ответы по порядку
+            writer.write(b''.join(data for _, _, data in stages))
+            await writer.drain()
+
+        for hop, stage, data in stages:
+            if not UPSTREAM_PIPELINING:
+                writer.write(data)
+                await writer.drain()
+            bound = await read_socks_reply(reader, stage, hop)
+            if stage == "connect":
+                now = time.monotonic()
+                record_hop_time(hop, now - started)
+                started = now
+    except BaseException:
+        # В том числе отмена по таймауту вызывающего
+        writer.close()
+        raise
+    return reader, writer, bound
+
+
+async def connect_to_upstream(proxy, dest_host, dest_port):
+    """Подключается к upstream SOCKS5 прокси (при CHAIN_FIRST_HOP - через первый hop)"""
+    hops = [CHAIN_FIRST_HOP, proxy] if CHAIN_FIRST_HOP else [proxy]
+
+    # Запросы собираются до подключения: ошибка в адресе назначения (ValueError)
+    # - ошибка клиента, и она не должна учитываться как отказ upstream
+    stages = build_handshake_stages(hops, dest_host, dest_port)
+    try:
+        reader, writer, _ = await open_socks_connection(hops[0], stages)
         return reader, writer
-        
     except Exception as e:
         raise Exception(f"Не удалось подключиться к upstream прокси: {e}")
 
 
+async def qualify_proxy(proxy):
+    """Проверяет кандидата: приветствие + CONNECT к тестовому адресу"""
+    started = time.monotonic()
+    try:
+        reader, writer = await asyncio.wait_for(
+            connect_to_upstream(proxy, QUALIFY_TARGET_HOST, QUALIFY_TARGET_PORT),
+            timeout=QUALIFY_TIMEOUT
+        )
+    except (Exception, asyncio.TimeoutError):
+        return None
+    writer.close()
+    return time.monotonic() - started
+
+
+async def qualify_proxy_list(candidates, first_ready=None):
+    """Параллельно проверяет кандидатов и добавляет прошедших в proxy_list"""
+    global proxy_list
+
+    started = time.monotonic()
+    qualified = []
+    qualification.update(running=True, total=len(candidates), checked=0, passed=0,
+                         first_ready_s=None, duration_s=None)
+    print_info(f"Проверка {len(candidates)} прокси (параллельно: {QUALIFY_CONCURRENCY})...")
+
+    # Общий итератор: воркеры забирают кандидатов по очереди, лучшие по пингу первыми
+    pending = iter(sorted(candidates, key=lambda p: p.get('ping', MAX_PING)))
+
+    # При первом запуске новый список нужен сразу. При обновлении прежний список
+    # работает, пока не наберется STRIPING_TOP_K проверенных прокси (или не закончится
+    # проверка), иначе все клиенты ушли бы на первый ответивший прокси
+    ready_at = max(STRIPING_TOP_K, 1) if proxy_list else 1
+
+    async def worker():
+        global proxy_list
+        for proxy in pending:
+            connect_time = await qualify_proxy(proxy)
+            qualification["checked"] += 1
+            if connect_time is None:
+                continue
+            record_upstream_result(proxy, True, connect_time)
+            qualified.append(proxy)
+            qualification["passed"] += 1
+            if len(qualified) == ready_at:
+                # Набралось достаточно прошедших - делаем новый список доступным
+                proxy_list = qualified
+                publish_routing()
+                qualification["first_ready_s"] = round(time.monotonic() - started, 2)
+                print_info(f"Рабочих прокси: {ready_at}, новый список доступен через "
+                           f"{qualification['first_ready_s']}с")
+                if first_ready:
+                    first_ready.set()
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(QUALIFY_CONCURRENCY, len(candidates)))))
+    except asyncio.CancelledError:
+        print_info(f"Проверка прервана новым обновлением списка ({len(qualified)} прошли)")
+        raise
+    finally:
+        qualification["running"] = False
+        qualification["duration_s"] = round(time.monotonic() - started, 2)
+        if first_ready:
+            first_ready.set()
+
+    if qualified:
+        if proxy_list is not qualified:
+            # Прошло меньше ready_at прокси - список применяется по окончании проверки
+            proxy_list = qualified
+        publish_routing()
+        print_info(f"Проверка завершена: {len(qualified)}/{len(candidates)} прокси работают "
+                   f"({qualification['duration_s']}с)")
+        save_upstream_cache()
+    elif proxy_list:
+        # Ни один не прошел (возможно, тестовый адрес временно недоступен) - оставляем прежний список
+        print_error("Ни один прокси не прошел проверку, оставляем прежний список")
+    else:
+        # Первый запуск и выбора нет - используем список как есть
+        print_error("Ни один прокси не прошел проверку, используем непроверенный список")
+        proxy_list = candidates
+    return bool(qualified)
+
+
+async def refresh_proxy_list():
+    """Загружает новый список прокси и, если включено, проверяет кандидатов"""
+    global qualify_task
+    loop = asyncio.get_running_loop()
+    if not QUALIFY_ENABLED:
+        return await loop.run_in_executor(None, load_proxy_list)
+
+    candidates = await loop.run_in_executor(None, fetch_proxy_candidates)
+    if not candidates:
+        return False
+
+    if qualify_task and not qualify_task.done():
+        # Новый список (например, после смены фильтров) заменяет проверяемый
+        qualify_task.cancel()
+        await asyncio.wait([qualify_task])
+
+    first_ready = asyncio.Event()
+    qualify_task = asyncio.create_task(qualify_proxy_list(candidates, first_ready))
+    # Ждем только первого рабочего прокси, остальные добавятся по мере проверки
+    await first_ready.wait()
+    return bool(proxy_list)
+
+
+def make_token_bucket(rate, burst=None):
+    """Создает token bucket: rate байт/с, burst - максимальный запас
+
+    Запас не меньше BUFFER_SIZE, чтобы в bucket помещалась хотя бы одна порция данных.
+    """
+    capacity = max(burst or rate, BUFFER_SIZE)
+    return {"rate": rate, "capacity": capacity, "tokens": capacity, "updated": time.monotonic()}
+
+
+def take_tokens(bucket, amount, reserve=0):
+    """Списывает токены и возвращает, сколько секунд нужно подождать (0 - сразу)
+
+    С reserve > 0 токены списываются, только если после этого в bucket останется
+    не меньше reserve, иначе возвращается время ожидания и запрос нужно повторить.
+    """
+    now = time.monotonic()
+    bucket["tokens"] = min(bucket["capacity"], bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"])
+    bucket["updated"] = now
+    if reserve > 0 and bucket["tokens"] - amount < reserve:
+        return (reserve + amount - bucket["tokens"]) / bucket["rate"]
+    bucket["tokens"] -= amount
+    if bucket["tokens"] >= 0:
+        return 0
+    return -bucket["tokens"] / bucket["rate"]
+
+
+def get_rate_bucket(key, limit):
+    """Возвращает общий bucket для лимита в КБ/с (None - лимит не задан)"""
+    if limit <= 0:
+        rate_buckets.pop(key, None)
+        return None
+    rate = limit * 1024
+    bucket = rate_buckets.get(key)
+    if bucket is None or bucket["rate"] != rate:
+        bucket = rate_buckets[key] = make_token_bucket(rate)
+    return bucket
+
+
+async def throttle(buckets, amount, bulk):
+    """Ждет, пока все лимиты скорости позволят передать amount байт
+
+    Интерактивные передачи могут уходить в долг, а bulk-передачи не трогают
+    последние BULK_RESERVE токенов, оставляя их интерактивным соединениям.
+    """
+    for bucket in buckets:
+        reserve = 0
+        if bulk:
+            # Резерв не больше того, что остается в полном bucket после списания,
+            # иначе условие недостижимо и bulk-передача ждала бы вечно
+            reserve = min(bucket["capacity"] * BULK_RESERVE, bucket["capacity"] - amount)
+        delay = take_tokens(bucket, amount, reserve)
+        while delay:
+            shaping_stats["throttled"] += 1
+            shaping_stats["throttled_time"] += delay
+            await asyncio.sleep(delay)
+            if reserve <= 0:
+                break  # Токены уже списаны в долг, ожидание его погасило
+            delay = take_tokens(bucket, amount, reserve)
+
+
+def police_tokens(buckets, amount):
+    """Списывает amount из всех bucket'ов без ожидания (для UDP)
+
+    Возвращает False и ничего не списывает, если хотя бы в одном не хватает токенов.
+    """
+    for bucket in buckets:
+        take_tokens(bucket, 0)  # Пополняем запас
+        if bucket["tokens"] < amount:
+            return False
+    for bucket in buckets:
+        bucket["tokens"] -= amount
+    return True
+
+
+def get_connection_buckets(proxy, client_ip, user):
+    """Лимиты скорости соединения: общий, на upstream, на клиента и на пользователя"""
+    return [bucket for bucket in (
+        get_rate_bucket(("global",), GLOBAL_BANDWIDTH_LIMIT),
+        get_rate_bucket(("upstream", proxy_key_of(proxy)), UPSTREAM_BANDWIDTH_LIMIT),
+        get_rate_bucket(("client", client_ip), CLIENT_BANDWIDTH_LIMIT),
+        user["bucket"] if user else None
+    ) if bucket]
+
+
+def take_user_slot(username, user):
+    """Учитывает соединение пользователя (False - квота одновременных соединений исчерпана)"""
+    if user["max_connections"] and user_active.get(username, 0) >= user["max_connections"]:
+        return False
+    user_active[username] = user_active.get(username, 0) + 1
+    return True
+
+
+def release_user_slot(username):
+    """Освобождает соединение пользователя"""
+    user_active[username] -= 1
+    if not user_active[username]:
+        del user_active[username]
+
+
+def release_client_slot(active_key):
+    """Снимает учет соединения клиента через upstream (client_ip, proxy_key)"""
+    client_active[active_key] -= 1
+    if not client_active[active_key]:
+        del client_active[active_key]
+        forget_idle_client(active_key[0])
+
+
+def forget_idle_client(client_ip):
+    """Удаляет состояние клиента без активных соединений (rate bucket и sticky-привязки)"""
+    if not any(key[0] == client_ip for key in client_active):
+        rate_buckets.pop(("client", client_ip), None)
+        client_assignments.pop(client_ip, None)
+
+
+def hash_password(password, salt):
+    """Хэширует пароль с солью (SHA-256)"""
+    import hashlib
+    return hashlib.sha256(salt + password).digest()
+
+
+def load_users():
+    """Загружает файл пользователей в индекс, если он изменился"""
+    global users, users_file_mtime
+
+    try:
+        mtime = os.stat(USERS_FILE).st_mtime
+    except OSError as e:
+        if users_file_mtime != 0:  # Сообщаем один раз, а не при каждой проверке
+            print_error(f"Файл пользователей {USERS_FILE} недоступен: {e}")
+        users_file_mtime = 0
+        return False
+    if mtime == users_file_mtime:
+        return False
+
+    try:
+        with open(USERS_FILE, encoding="utf-8") as f:
+            lines = f.readlines()
+    except (OSError, ValueError) as e:  # UnicodeDecodeError - подкласс ValueError
+        print_error(f"Не удалось прочитать {USERS_FILE}: {e}")
+        users_file_mtime = mtime  # Сообщаем один раз, прежний список пользователей остается
+        return False
+
+    index = {}
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        # имя:пароль[:макс. соединений[:лимит КБ/с]]
+        fields = line.split(":")
+        if len(fields) < 2:
+            print_error(f"{USERS_FILE}:{line_no}: ожидается имя:пароль")
+            continue
+        name, secret = fields[0], fields[1]
+        try:
+            max_connections = int(fields[2]) if len(fields) > 2 and fields[2] else USER_MAX_CONNECTIONS
+            limit = int(fields[3]) if len(fields) > 3 and fields[3] else USER_BANDWIDTH_LIMIT
+        except ValueError:
+            print_error(f"{USERS_FILE}:{line_no}: лимиты должны быть числами")
+            continue
+
+        if secret.startswith("sha256$"):
+            # Уже хэшированный пароль: sha256$соль_hex$хэш_hex
+            try:
+                _, salt_hex, hash_hex = secret.split("$")
+                salt, digest = bytes.fromhex(salt_hex), bytes.fromhex(hash_hex)
+            except ValueError:
+                print_error(f"{USERS_FILE}:{line_no}: неверный формат хэша")
+                continue
+        else:
+            salt = os.urandom(16)
+            digest = hash_password(secret.encode(), salt)
+
+        previous = users.get(name)
+        bucket = None
+        if limit > 0:
+            rate = limit * 1024
+            if previous and previous["bucket"] and previous["bucket"]["rate"] == rate:
+                bucket = previous["bucket"]  # Сохраняем состояние при перезагрузке
+            else:
+                bucket = make_token_bucket(rate)
+        index[name] = {"salt": salt, "hash": digest, "max_connections": max_connections, "bucket": bucket}
+
+    users = index
+    users_file_mtime = mtime
+    print_info(f"👤 Загружено пользователей: {len(users)} из {USERS_FILE}")
+    return True
+
+
+def check_credentials(username, password):
+    """Проверяет логин и пароль по индексу, возвращает запись пользователя"""
+    import hmac
+
+    user = users.get(username)
+    if user is None:
+        return None
+    if not hmac.compare_digest(hash_password(password, user["salt"]), user["hash"]):
+        return None
+    return user
+
+
+async def watch_users_file_periodically():
+    """Периодически перечитывает файл пользователей при его изменении
+
+    Работает всегда: CLIENT_AUTH можно включить без перезапуска (SIGHUP).
+    """
+    while True:
+        await asyncio.sleep(USERS_RELOAD_INTERVAL)
+        if not CLIENT_AUTH:
+            continue
+        try:
+            load_users()
+        except (OSError, ValueError) as e:
+            print_error(f"Ошибка загрузки {USERS_FILE}: {e}")
+
+
+async def authenticate_client(client_reader, client_writer, methods):
+    """Аутентификация клиента по логину и паролю (RFC 1929), возвращает имя или None"""
+    global auth_failures
+
+    if 0x02 not in methods:
+        client_writer.write(b'\x05\xff')  # Нет подходящих методов
+        await client_writer.drain()
+        return None
+    client_writer.write(b'\x05\x02')
+    await client_writer.drain()
+
+    header = await asyncio.wait_for(client_reader.readexactly(2), timeout=CLIENT_TIMEOUT)
+    username = await client_reader.readexactly(header[1])
+    password_len = (await client_reader.readexactly(1))[0]
+    password = await client_reader.readexactly(password_len)
+
+    username = username.decode(errors="replace")
+    if header[0] != 0x01 or check_credentials(username, password) is None:
+        auth_failures += 1
+        if VERBOSE or auth_failures % 10 == 1:
+            print_error(f"Неудачная аутентификация: {username!r} (всего: {auth_failures})")
+        client_writer.write(b'\x01\x01')
+        await client_writer.drain()
+        return None
+
+    client_writer.write(b'\x01\x00')
+    await client_writer.drain()
+    return username
+
+
+class UdpRelayProtocol(asyncio.DatagramProtocol):
+    """Одна сторона UDP ассоциации: сокет для клиента или сокет для relay upstream
+
+    Заголовок SOCKS5 UDP (RSV, FRAG, ATYP, адрес, порт) одинаков в обе стороны,
+    поэтому датаграммы пересылаются как есть, без разбора и копирования.
+    Сокетов два: клиентский привязан к адресу, на который подключился клиент
+    (по умолчанию 127.0.0.1), а с такого адреса нельзя отправлять во внешнюю сеть.
+    """
+
+    def __init__(self, association, from_client):
+        self.association = association
+        self.from_client = from_client
+
+    def datagram_received(self, data, addr):
+        association = self.association
+        if self.from_client:
+            # Фрагментированные датаграммы (FRAG != 0) не поддерживаются
+            if addr[0] != association["client_ip"] or len(data) <= 4 or data[2] != 0x00:
+                udp_stats["dropped"] += 1
+                return
+            association["client_addr"] = addr
+            target, target_addr = association["upstream"], None
+        else:
+            if association["client_addr"] is None:
+                udp_stats["dropped"] += 1
+                return
+            target, target_addr = association["client"], association["client_addr"]
+
+        # Датаграммы не ждут лимита скорости: при превышении они отбрасываются
+        if association["buckets"] and not police_tokens(association["buckets"], len(data)):
+            udp_stats["dropped"] += 1
+            shaping_stats["throttled"] += 1
+            return
+        association["last_activity"] = time.monotonic()
+        udp_stats["datagrams"] += 1
+        udp_stats["bytes"] += len(data)
+        target.sendto(data, target_addr)
+
+    def error_received(self, exc):
+        # Ошибки отправки и ICMP ответы: датаграмма потеряна
+        udp_stats["dropped"] += 1
+        if VERBOSE:
+            print_error(f"Ошибка UDP relay: {exc}")
+
+
+async def open_upstream_udp_association(proxy):
+    """Выполняет UDP ASSOCIATE на upstream прокси, возвращает управляющее соединение и адрес relay"""
+    stages = build_handshake_stages([proxy], "0.0.0.0", 0, command=0x03)
+    try:
+        reader, writer, (relay_host, relay_port) = await open_socks_connection(proxy, stages)
+    except Exception as e:
+        raise Exception(f"Не удалось подключиться к upstream прокси (UDP): {e}")
+
+    # Адрес 0.0.0.0 означает "тот же хост, что и управляющее соединение"
+    if relay_host in ("0.0.0.0", "::"):
+        relay_host = writer.get_extra_info('peername')[0]
+    relay_ip = await resolve_host(relay_host)
+    if relay_ip is None:
+        writer.close()
+        raise Exception(f"Не удалось подключиться к upstream прокси (UDP): DNS {relay_host}")
+    return reader, writer, (relay_ip, relay_port)
+
+
+async def handle_udp_associate(client_reader, client_writer, proxy, username=None):
+    """Обрабатывает команду UDP ASSOCIATE: relay живет, пока открыто TCP соединение"""
+    client_ip = client_writer.get_extra_info('peername')[0]
+    local_ip = client_writer.get_extra_info('sockname')[0]
+
+    # Ассоциация занимает одно из одновременных соединений пользователя
+    user = users.get(username) if username else None
+    if user and not take_user_slot(username, user):
+        client_writer.write(b'\x05\x02\x00\x01' + b'\x00' * 6)  # Not allowed by ruleset
+        await client_writer.drain()
+        return
+
+    active_key = None
+    upstream_writer = None
+    association = {
+        "client_ip": client_ip,
+        "client_addr": None,  # Становится известен по первой датаграмме клиента
+        "client": None,       # Сокет, который видит клиент
+        "upstream": None,     # Сокет, подключенный к relay upstream
+        "last_activity": time.monotonic(),
+        "buckets": get_connection_buckets(proxy, client_ip, user)
+    }
+    try:
+        upstream_reader, upstream_writer, relay_addr = await open_upstream_udp_association(proxy)
+        active_key = (client_ip, proxy_key_of(proxy))
+        client_active[active_key] = client_active.get(active_key, 0) + 1
+
+        loop = asyncio.get_running_loop()
+        association["client"], _ = await loop.create_datagram_endpoint(
+            lambda: UdpRelayProtocol(association, True),
+            local_addr=(local_ip, 0)
+        )
+        # Адрес отправителя выберет система по маршруту до relay
+        association["upstream"], _ = await loop.create_datagram_endpoint(
+            lambda: UdpRelayProtocol(association, False),
+            remote_addr=relay_addr
+        )
+        udp_stats["associations"] += 1
+        udp_stats["active"] += 1
+
+        # Сообщаем клиенту адрес нашего UDP сокета
+        bound_ip, bound_port = association["client"].get_extra_info('sockname')[:2]
+        client_writer.write(b'\x05\x00\x00' + encode_socks_address(bound_ip) + bound_port.to_bytes(2, 'big'))
+        await client_writer.drain()
+        if VERBOSE:
+            print_info(f"✓ UDP relay {bound_ip}:{bound_port} -> {relay_addr[0]}:{relay_addr[1]} "
+                       f"через прокси {proxy['ip']}:{proxy['port']}")
+
+        # Ассоциация закрывается вместе с TCP соединением клиента или upstream,
+        # либо после UDP_IDLE_TIMEOUT секунд без датаграмм
+        closed = [asyncio.ensure_future(client_reader.read(1)),
+                  asyncio.ensure_future(upstream_reader.read(1))]
+        try:
+            while True:
+                done, _ = await asyncio.wait(closed, timeout=UDP_IDLE_TIMEOUT,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if done or time.monotonic() - association["last_activity"] >= UDP_IDLE_TIMEOUT:
+                    break
+        finally:
+            for task in closed:
+                task.cancel()
+    finally:
+        if association["upstream"]:
+            association["upstream"].close()
+            udp_stats["active"] -= 1
+        if association["client"]:
+            association["client"].close()
+        if upstream_writer:
+            upstream_writer.close()
+        if active_key:
+            release_client_slot(active_key)
+        if user:
+            release_user_slot(username)
+
+
+async def open_tunnel(client_reader, client_writer, client_ip, dest_addr, dest_port, reply,
+                      username=None, resolve_domain=False):
+    """Подключается к адресу назначения через upstream прокси и передает данные
+
+    Общий движок для SOCKS5 и HTTP CONNECT: выбор upstream, квоты, лимиты скорости,
+    relay и учет ошибок. reply(код) отправляет клиенту ответ в формате протокола
+    (коды - как в ответе SOCKS5: 0x00 - успех, 0x01 - ошибка, 0x02 - запрещено,
+    0x04 - узел недоступен)
+    """
+    global successful_connections, total_connections
+    upstream_writer = None
+    proxy = None
+    active_key = None
+    counted_user = None
+    established = False
+
+    try:
+        if resolve_domain and DNS_MODE == "local":
+            # Локальное разрешение имен: upstream получит уже IP адрес
+            resolved = await asyncio.wait_for(resolve_host(dest_addr), timeout=CONNECTION_TIMEOUT)
+            if resolved is None:
+                await reply(0x04)  # Host unreachable
+                return
+            dest_addr = resolved
+        
+        # Квота пользователя на одновременные соединения
+        user = users.get(username) if username else None
+        if user:
+            if not take_user_slot(username, user):
+                await reply(0x02)  # Not allowed by ruleset
+                return
+            counted_user = username
+        
+        # Подключаемся к upstream прокси (при быстром старте список может еще загружаться)
+        if routing.current is None:
+            await wait_for_upstream()
+        proxy = select_upstream_for_client(client_ip, dest_addr)
+        if not proxy:
+            raise Exception("Прокси не выбран")
+        
+        total_connections += 1
+        
+        connect_started = time.monotonic()
+        upstream_reader, upstream_writer = await connect_to_upstream(
+            proxy,
+            dest_addr,
+            dest_port
+        )
+        stats = record_upstream_result(proxy, True, time.monotonic() - connect_started)
+        stats["active"] += 1
+        active_key = (client_ip, proxy_key_of(proxy))
+        client_active[active_key] = client_active.get(active_key, 0) + 1
+        
+        # Успешное подключение!
+        successful_connections += 1
+        print_info(f"✓ Подключено к {dest_addr}:{dest_port} через прокси "
+                   f"{proxy['ip']}:{proxy['port']} "
+                   f"({proxy.get('country', 'N/A')}) "
+                   f"[Успешных: {successful_connections}/{total_connections}]")
+        
+        # Отправляем успешный ответ клиенту
+        established = True
+        await reply(0x00)
+        
+        # Лимиты скорости: общий, на upstream, на клиента и на пользователя
+        buckets = get_connection_buckets(proxy, client_ip, user)
+        
+        # Проксируем данные
+        async def forward(reader, writer, direction):
+            burst_bytes = 0  # Объем текущей непрерывной передачи
+            last_chunk = 0
+            try:
+                while True:
+                    data = await reader.read(BUFFER_SIZE)
+                    if not data:
+                        break
+                    stats["bytes"] += len(data)
+                    if buckets:
+                        # Передача после паузы считается новой (интерактивной)
+                        now = time.monotonic()
+                        if now - last_chunk > 1:
+                            burst_bytes = 0
+                        last_chunk = now
+                        burst_bytes += len(data)
+                        await throttle(buckets, len(data), burst_bytes > BULK_THRESHOLD)
+                    writer.write(data)
+                    await writer.drain()
+            except:
+                pass
+            finally:
+                try:
+                    writer.close()
+                    await writer.wait_closed()
+                except:
+                    pass
+        
+        # Запускаем двустороннюю передачу данных
+        await asyncio.gather(
+            forward(client_reader, upstream_writer, "client->upstream"),
+            forward(upstream_reader, client_writer, "upstream->client"),
+            return_exceptions=True
+        )
+        
+    except Exception as e:
+        if not established:
+            try:
+                await reply(0x01)  # General failure
+            except Exception:
+                pass
+        error_msg = str(e)
+        
+        # Если ошибка связана с upstream прокси
+        if "upstream" in error_msg.lower() or "connect" in error_msg.lower():
+            if proxy:
+                record_upstream_result(proxy, False)
+                control_call(report_upstream_failure, proxy, error_msg)
+        elif VERBOSE:
+            # Другие ошибки логируем только в verbose режиме
+            print_error(f"Ошибка обработки клиента: {e}")
+    finally:
+        if counted_user:
+            release_user_slot(counted_user)
+        if active_key:
+            upstream_stats[active_key[1]]["active"] -= 1
+            release_client_slot(active_key)
+        elif proxy:
+            forget_idle_client(client_ip)  # Подключение не удалось - привязка могла остаться
+        if upstream_writer:
+            try:
+                upstream_writer.close()
+                await upstream_writer.wait_closed()
+            except:
+                pass
+
+
 async def handle_socks5_client(client_reader, client_writer):
     """Обрабатывает SOCKS5 клиента"""
-    global connection_errors, invalid_socks_count, successful_connections, total_connections
-    upstream_writer = None
+    global invalid_socks_count, active_clients
+    username = None
+    active_clients += 1
+    if startup["first_accept_s"] is None:
+        record_first_accept()
     
     try:
         client_addr = client_writer.get_extra_info('peername')
@@ -230,14 +1338,21 @@ async def handle_socks5_client(client_reader, client_writer):
         nmethods = greeting[1]
         methods = await client_reader.readexactly(nmethods)
         
-        # Отправляем ответ (no authentication required)
-        client_writer.write(b'\x05\x00')
-        await client_writer.drain()
+        if CLIENT_AUTH:
+            username = await authenticate_client(client_reader, client_writer, methods)
+            if username is None:
+                return
+        else:
+            # Отправляем ответ (no authentication required)
+            client_writer.write(b'\x05\x00')
+            await client_writer.drain()
         
         # Читаем запрос на подключение
         request = await asyncio.wait_for(client_reader.readexactly(4), timeout=CLIENT_TIMEOUT)
         
-        if request[0] != 0x05 or request[1] != 0x01:  # VER != 5 or CMD != CONNECT
+        # Поддерживаются CONNECT и UDP ASSOCIATE (UDP - только без цепочки прокси)
+        udp_allowed = UDP_ENABLED and not CHAIN_FIRST_HOP
+        if request[0] != 0x05 or not (request[1] == 0x01 or (request[1] == 0x03 and udp_allowed)):
             client_writer.write(b'\x05\x07\x00\x01' + b'\x00' * 6)  # Command not supported
             await client_writer.drain()
             return
@@ -260,91 +1375,186 @@ async def handle_socks5_client(client_reader, client_writer):
         
         dest_port = int.from_bytes(await client_reader.readexactly(2), 'big')
         
-        # Подключаемся к upstream прокси
-        if not current_proxy:
-            raise Exception("Прокси не выбран")
-        
-        total_connections += 1
-        
-        upstream_reader, upstream_writer = await connect_to_upstream(
-            current_proxy['ip'],
-            current_proxy['port'],
-            dest_addr,
-            dest_port
-        )
-        
-        # Успешное подключение!
-        successful_connections += 1
-        print_info(f"✓ Подключено к {dest_addr}:{dest_port} через прокси "
-                   f"{current_proxy['ip']}:{current_proxy['port']} "
-                   f"({current_proxy.get('country', 'N/A')}) "
-                   f"[Успешных: {successful_connections}/{total_connections}]")
-        
-        # Отправляем успешный ответ клиенту
-        client_writer.write(b'\x05\x00\x00\x01' + b'\x00' * 6)
-        await client_writer.drain()
-        
-        # Проксируем данные
-        async def forward(reader, writer, direction):
+        if request[1] == 0x03:
+            proxy = routing.current or await wait_for_upstream()
+            if not proxy:
+                raise Exception("Прокси не выбран")
             try:
-                while True:
-                    data = await reader.read(BUFFER_SIZE)
-                    if not data:
-                        break
-                    writer.write(data)
-                    await writer.drain()
-            except:
-                pass
-            finally:
-                try:
-                    writer.close()
-                    await writer.wait_closed()
-                except:
-                    pass
+                await handle_udp_associate(client_reader, client_writer, proxy, username)
+            except Exception as e:
+                # UDP поддерживают не все upstream - это не повод менять прокси
+                if VERBOSE:
+                    print_error(f"UDP ASSOCIATE не удался: {e}")
+                client_writer.write(b'\x05\x01\x00\x01' + b'\x00' * 6)  # General failure
+                await client_writer.drain()
+            return
         
-        # Запускаем двустороннюю передачу данных
-        await asyncio.gather(
-            forward(client_reader, upstream_writer, "client->upstream"),
-            forward(upstream_reader, client_writer, "upstream->client"),
-            return_exceptions=True
-        )
+        async def reply(code):
+            client_writer.write(bytes([0x05, code, 0x00, 0x01]) + b'\x00' * 6)
+            await client_writer.drain()
         
-    except Exception as e:
-        error_msg = str(e)
+        await open_tunnel(client_reader, client_writer,
+                          client_addr[0] if client_addr else None, dest_addr, dest_port,
+                          reply, username, resolve_domain=atyp == 0x03)
         
-        # Если ошибка связана с upstream прокси
-        if "upstream" in error_msg.lower() or "connect" in error_msg.lower():
-            connection_errors += 1
-            
-            # Добавляем прокси в blacklist если он явно не работает
-            if current_proxy:
-                if connection_errors % 3 == 0:  # Логируем каждую 3-ю ошибку
-                    print_error(f"Ошибка подключения к upstream ({connection_errors}): {e}")
-                
-                if connection_errors >= 3:
-                    add_to_blacklist(current_proxy['ip'], current_proxy['port'], 
-                                   "множественные ошибки подключения")
-            
-            # Проверяем, нужно ли переключиться на другой прокси
-            if should_switch_proxy():
-                print_info("Слишком много ошибок, переключаемся на другой прокси...")
-                select_random_proxy()
-        else:
-            # Другие ошибки логируем только в verbose режиме
+    except Exception as e:
+        # Ошибки upstream обрабатывает open_tunnel, остальные логируем только в verbose режиме
+        if VERBOSE:
+            print_error(f"Ошибка обработки клиента: {e}")
+    finally:
+        active_clients -= 1
+        try:
+            client_writer.close()
+            await client_writer.wait_closed()
+        except:
+            pass
+
+
+def record_first_accept():
+    """Запоминает время до первого принятого клиентского соединения"""
+    startup["first_accept_s"] = round(time.monotonic() - PROCESS_STARTED, 3)
+    print_info(f"⚡ Первое соединение принято через {startup['first_accept_s']}с после запуска "
+               f"(порты открыты через {startup['listening_s']}с)")
+
+
+# Ответы HTTP CONNECT на коды open_tunnel
+HTTP_CONNECT_STATUS = {
+    0x00: "200 Connection established",
+    0x01: "502 Bad Gateway",
+    0x02: "403 Forbidden",
+    0x04: "502 Bad Gateway"
+}
+
+
+def parse_connect_head(head):
+    """Разбирает заголовок HTTP CONNECT: (host, port, Proxy-Authorization) или None"""
+    lines = head.split(b"\r\n")
+    parts = lines[0].split(b" ")
+    if len(parts) != 3 or parts[0] != b"CONNECT" or not parts[2].startswith(b"HTTP/1."):
+        return None
+
+    # host:port или [IPv6]:port
+    host, sep, port = parts[1].rpartition(b":")
+    if not sep or not port.isdigit() or not 0 < int(port) < 65536:
+        return None
+    try:
+        # Имена не в ASCII приводятся к IDNA, как это сделал бы клиент SOCKS5
+        host = host.decode("ascii")
+    except UnicodeDecodeError:
+        try:
+            host = host.decode("utf-8").encode("idna").decode("ascii")
+        except UnicodeError:
+            return None
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+    # В SOCKS5 длина имени хоста занимает один байт
+    if not host or len(host) > 255:
+        return None
+
+    authorization = None
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"proxy-authorization":
+            authorization = value.strip()
+            break
+    return host, int(port), authorization
+
+
+def check_basic_auth(authorization):
+    """Проверяет Proxy-Authorization: Basic, возвращает имя пользователя или None"""
+    import base64
+    global auth_failures
+
+    username = None
+    scheme, _, token = (authorization or b"").partition(b" ")
+    if scheme.lower() == b"basic":
+        try:
+            name, _, password = base64.b64decode(token.strip(), validate=True).partition(b":")
+        except ValueError:
+            name, password = b"", b""
+        name = name.decode(errors="replace")
+        if name and check_credentials(name, password) is not None:
+            username = name
+
+    if username is None and authorization is not None:
+        auth_failures += 1
+        if VERBOSE or auth_failures % 10 == 1:
+            print_error(f"Неудачная аутентификация HTTP CONNECT (всего: {auth_failures})")
+    return username
+
+
+async def handle_http_connect_client(client_reader, client_writer):
+    """Обрабатывает клиента HTTP CONNECT"""
+    global active_clients
+    active_clients += 1
+    if startup["first_accept_s"] is None:
+        record_first_accept()
+
+    async def respond(status, headers=b""):
+        client_writer.write(b"HTTP/1.1 " + status.encode() + b"\r\n" + headers + b"\r\n")
+        await client_writer.drain()
+
+    try:
+        client_addr = client_writer.get_extra_info('peername')
+
+        # Заголовок читается целиком одним вызовом; лимит буфера потока
+        # равен HTTP_MAX_HEADER_SIZE (см. start_listener)
+        try:
+            head = await asyncio.wait_for(client_reader.readuntil(b"\r\n\r\n"), timeout=CLIENT_TIMEOUT)
+        except asyncio.LimitOverrunError:
+            head = None
+        if head is None or len(head) > HTTP_MAX_HEADER_SIZE:
+            await respond("431 Request Header Fields Too Large", b"Connection: close\r\n")
+            return
+
+        if not head.startswith(b"CONNECT "):
+            await respond("405 Method Not Allowed", b"Allow: CONNECT\r\nConnection: close\r\n")
+            return
+        request = parse_connect_head(head[:-4])
+        if request is None:
             if VERBOSE:
-                print_error(f"Ошибка обработки клиента: {e}")
+                print_error(f"Неверный запрос HTTP CONNECT: {head[:80]!r}")
+            await respond("400 Bad Request", b"Connection: close\r\n")
+            return
+        dest_addr, dest_port, authorization = request
+
+        username = None
+        if CLIENT_AUTH:
+            username = check_basic_auth(authorization)
+            if username is None:
+                await respond("407 Proxy Authentication Required",
+                              b'Proxy-Authenticate: Basic realm="tg-proxy"\r\nConnection: close\r\n')
+                return
+
+        async def reply(code):
+            await respond(HTTP_CONNECT_STATUS.get(code, HTTP_CONNECT_STATUS[0x01]))
+
+        # Данные, пришедшие вслед за заголовком, остаются в буфере и уйдут в relay
+        await open_tunnel(client_reader, client_writer,
+                          client_addr[0] if client_addr else None, dest_addr, dest_port,
+                          reply, username, resolve_domain=not is_ip_address(dest_addr))
+
+    except Exception as e:
+        if VERBOSE:
+            print_error(f"Ошибка обработки HTTP CONNECT клиента: {e}")
     finally:
+        active_clients -= 1
         try:
             client_writer.close()
             await client_writer.wait_closed()
         except:
             pass
-        if upstream_writer:
-            try:
-                upstream_writer.close()
-                await upstream_writer.wait_closed()
-            except:
-                pass
+
+
+async def load_initial_proxy_list():
+    """Загружает первый список прокси в фоне (быстрый старт), повторяя при ошибке"""
+    while not await refresh_proxy_list():
+        print_error("Не удалось загрузить список прокси, повтор через 10 секунд")
+        await asyncio.sleep(10)
+    if startup["source"] is None:
+        startup["source"] = "download"
+    if not current_proxy_listed():
+        select_random_proxy()  # Прокси из кэша остается, если прошел проверку
 
 
 async def update_proxy_list_periodically():
@@ -352,11 +1562,42 @@ async def update_proxy_list_periodically():
     while True:
         await asyncio.sleep(UPDATE_INTERVAL)
         print_info("Обновление списка прокси...")
-        load_proxy_list()
-        if proxy_list:
+        await refresh_proxy_list()
+        if proxy_list and not current_proxy_listed():
             select_random_proxy()
 
 
+async def sample_throughput_periodically():
+    """Периодически замеряет суммарную пропускную способность upstream прокси"""
+    previous = {}
+
+    while True:
+        await asyncio.sleep(THROUGHPUT_INTERVAL)
+
+        rates = {}
+        for key, stats in list(upstream_stats.items()):  # Копия: словарь пополняет data plane
+            delta = stats["bytes"] - previous.get(key, 0)
+            previous[key] = stats["bytes"]
+            if delta > 0:
+                rates[key] = delta / THROUGHPUT_INTERVAL
+
+        aggregate = sum(rates.values())
+        best_single = max(rates.values(), default=0)
+        throughput["mode"] = "striping" if STRIPING_ENABLED else "single"
+        throughput["aggregate_bps"] = int(aggregate)
+        throughput["best_single_bps"] = int(best_single)
+        throughput["upstreams_used"] = len(rates)
+        if aggregate > throughput["peak_aggregate_bps"]:
+            # Оба значения пика берутся из одного окна, иначе их отношение ничего не значит
+            throughput["peak_aggregate_bps"] = int(aggregate)
+            throughput["peak_busiest_bps"] = int(best_single)
+
+
+def format_rate(bps):
+    """Форматирует скорость в КБ/с"""
+    return f"{bps / 1024:.1f} КБ/с"
+
+
 async def print_statistics_periodically():
     """Периодически выводит статистику работы"""
     STATS_INTERVAL = 300  # Каждые 5 минут
@@ -373,6 +1614,16 @@ async def print_statistics_periodically():
             print_info(f"  🚫 Прокси в blacklist: {len(proxy_blacklist)}")
             if current_proxy:
                 print_info(f"  🌍 Текущий прокси: {current_proxy['ip']}:{current_proxy['port']} ({current_proxy.get('country', 'N/A')})")
+            if throughput["peak_aggregate_bps"]:
+                ratio = throughput["peak_aggregate_bps"] / max(throughput["peak_busiest_bps"], 1)
+                print_info(f"  🚀 Пиковая скорость ({throughput['mode']}): "
+                           f"{format_rate(throughput['peak_aggregate_bps'])} суммарно, "
+                           f"{format_rate(throughput['peak_busiest_bps'])} через самый загруженный upstream "
+                           f"(x{ratio:.2f})")
+            if loop_lag_samples:
+                lag = get_loop_lag_stats()
+                print_info(f"  ⏱️ Задержка event loop: p50 {lag['p50_ms']}ms, p99 {lag['p99_ms']}ms, "
+                           f"max {lag['max_ms']}ms, блокировок: {lag['slow_callbacks']}")
             print_info("=" * 60)
 
 
@@ -391,9 +1642,166 @@ async def clean_blacklist_periodically():
                 to_remove = list(proxy_blacklist)[:remove_count]
                 for proxy_key in to_remove:
                     proxy_blacklist.remove(proxy_key)
+                publish_routing()
                 print_info(f"🔄 Очищено {remove_count} прокси из blacklist ({old_count} -> {len(proxy_blacklist)})")
 
 
+async def publish_routing_periodically():
+    """Периодически пересчитывает top-K по свежей статистике и публикует снимок"""
+    ROUTING_INTERVAL = 5  # Каждые 5 секунд
+
+    while True:
+        await asyncio.sleep(ROUTING_INTERVAL)
+        publish_routing()
+
+
+def control_call(func, *args):
+    """Выполняет func в потоке control plane (сразу, если он не запущен)"""
+    if control_loop is None:
+        func(*args)
+    else:
+        control_loop.call_soon_threadsafe(func, *args)
+
+
+async def run_in_control_plane(coro):
+    """Выполняет корутину в event loop control plane и возвращает ее результат"""
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, control_loop))
+
+
+def control_plane_worker(ready):
+    """Поток control plane: собственный event loop для фоновых задач"""
+    global control_loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    control_loop = loop
+    loop.call_soon(ready.set)
+    loop.run_forever()
+
+
+def start_control_plane():
+    """Запускает поток control plane
+
+    Загрузка и проверка списка, оценка upstream, статистика и веб-интерфейс
+    работают в отдельном потоке со своим event loop и не добавляют задержек
+    в event loop, передающий данные клиентов.
+    """
+    ready = threading.Event()
+    thread = threading.Thread(target=control_plane_worker, args=(ready,),
+                              name="control-plane", daemon=True)
+    thread.start()
+    ready.wait()
+
+
+async def start_control_tasks():
+    """Запускает фоновые задачи и веб-интерфейс в control plane"""
+    asyncio.create_task(watch_users_file_periodically())
+    asyncio.create_task(update_proxy_list_periodically())
+    asyncio.create_task(print_statistics_periodically())
+    asyncio.create_task(sample_throughput_periodically())
+    asyncio.create_task(clean_blacklist_periodically())
+    asyncio.create_task(publish_routing_periodically())
+    publish_routing()
+
+    # Запускаем HTTP сервер (веб-интерфейс)
+    return await start_listener(
+        "http",
+        handle_http_request,
+        "0.0.0.0",
+        5000
+    )
+
+
+def percentile(sorted_values, pct):
+    """Возвращает перцентиль (nearest-rank) из отсортированного списка"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def describe_blocking_frame(frame):
+    """Находит в стеке место, блокирующее event loop"""
+    import traceback
+
+    stack = traceback.extract_stack(frame)
+    # Предпочитаем кадры из нашего модуля, а не из asyncio/stdlib
+    own = [f for f in stack if f.filename == __file__]
+    top = own[-1] if own else stack[-1]
+    return f"{top.name} ({top.filename}:{top.lineno})", traceback.format_list(stack[-15:])
+
+
+def loop_lag_worker(loop, loop_thread_id, stop_event):
+    """Поток-наблюдатель: измеряет задержку event loop и ловит блокировки"""
+    global slow_callback_count
+
+    ack = threading.Event()
+    ack_time = [0.0]
+
+    def on_ack():
+        ack_time[0] = time.monotonic()
+        ack.set()
+
+    while not stop_event.is_set():
+        ack.clear()
+        sent = time.monotonic()
+        try:
+            loop.call_soon_threadsafe(on_ack)
+        except RuntimeError:
+            return  # Event loop закрыт
+
+        stack = None
+        if not ack.wait(SLOW_CALLBACK_THRESHOLD):
+            # Loop не ответил вовремя - снимаем стек, пока он ещё заблокирован
+            frame = sys._current_frames().get(loop_thread_id)
+            if frame is not None:
+                stack = describe_blocking_frame(frame)
+            while not ack.wait(1.0):
+                if stop_event.is_set() or loop.is_closed():
+                    return
+
+        lag = ack_time[0] - sent
+        loop_lag_samples.append(lag)
+
+        if lag >= SLOW_CALLBACK_THRESHOLD:
+            slow_callback_count += 1
+            where, frames = stack if stack else ("неизвестно", [])
+            slow_callbacks.append({
+                "timestamp": int(time.time()),
+                "duration_ms": round(lag * 1000, 1),
+                "callback": where,
+                "stack": frames
+            })
+
+        stop_event.wait(LOOP_LAG_INTERVAL)
+
+
+def start_loop_lag_monitor():
+    """Запускает поток мониторинга задержки event loop"""
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=loop_lag_worker,
+        args=(asyncio.get_running_loop(), threading.get_ident(), stop_event),
+        name="loop-lag-monitor",
+        daemon=True
+    )
+    thread.start()
+    return stop_event
+
+
+def get_loop_lag_stats():
+    """Возвращает статистику задержки event loop в миллисекундах"""
+    samples = sorted(list(loop_lag_samples))
+    return {
+        "samples": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "p90_ms": round(percentile(samples, 90) * 1000, 2),
+        "p99_ms": round(percentile(samples, 99) * 1000, 2),
+        "max_ms": round(samples[-1] * 1000, 2) if samples else 0.0,
+        "slow_callbacks": slow_callback_count,
+        "slow_callback_threshold_ms": round(SLOW_CALLBACK_THRESHOLD * 1000, 1)
+    }
+
+
 async def handle_http_request(reader, writer):
     """Обрабатывает HTTP запрос для веб-интерфейса"""
     try:
@@ -424,6 +1832,8 @@ async def handle_http_request(reader, writer):
             response = generate_web_interface()
         elif path == '/api/status':
             response = generate_status_json()
+        elif path == '/metrics':
+            response = generate_metrics()
         else:
             response = generate_404()
         
@@ -629,7 +2039,15 @@ def generate_status_json():
             "current": f"{current_proxy['ip']}:{current_proxy['port']}" if current_proxy else None,
             "country": current_proxy.get('country') if current_proxy else None,
             "available": len(proxy_list),
-            "blacklisted": len(proxy_blacklist)
+            "blacklisted": len(proxy_blacklist),
+            "routing_version": routing.version,
+            "hops": [
+                {
+                    "proxy": proxy_key_of(hop),
+                    "handshake_ms": round(upstream_stats.get(proxy_key_of(hop), {}).get("handshake_time", 0) * 1000, 1)
+                }
+                for hop in ([CHAIN_FIRST_HOP] if CHAIN_FIRST_HOP else []) + ([current_proxy] if current_proxy else [])
+            ]
         },
         "connections": {
             "successful": successful_connections,
@@ -640,6 +2058,31 @@ def generate_status_json():
             "invalid_socks": invalid_socks_count,
             "connection_errors": connection_errors
         },
+        "throughput": dict(
+            throughput,
+            # Суммарная скорость против самого загруженного upstream в том же окне
+            # (не сравнение с режимом одного upstream - он в этом процессе не замеряется)
+            aggregate_vs_busiest=round(throughput["peak_aggregate_bps"] / max(throughput["peak_busiest_bps"], 1), 2),
+            active_upstreams=[key for key, stats in list(upstream_stats.items()) if stats["active"] > 0]
+        ),
+        "qualification": qualification,
+        "udp": dict(udp_stats, enabled=UDP_ENABLED),
+        "shaping": {
+            "global_kbps": GLOBAL_BANDWIDTH_LIMIT,
+            "upstream_kbps": UPSTREAM_BANDWIDTH_LIMIT,
+            "client_kbps": CLIENT_BANDWIDTH_LIMIT,
+            "throttled": shaping_stats["throttled"],
+            "throttled_time_s": round(shaping_stats["throttled_time"], 2)
+        },
+        "auth": {
+            "enabled": CLIENT_AUTH,
+            "users": len(users),
+            "active_users": len(user_active),
+            "failures": auth_failures
+        },
+        "dns": dict(dns_stats, mode=DNS_MODE, cached=len(dns_cache), inflight=len(dns_inflight)),
+        "event_loop": dict(get_loop_lag_stats(), recent_slow_callbacks=list(slow_callbacks)),
+        "startup": startup,
         "timestamp": int(time.time())
     }
     
@@ -654,6 +2097,55 @@ def generate_status_json():
     return response
 
 
+def generate_metrics():
+    """Генерирует метрики в текстовом формате Prometheus"""
+    lag = get_loop_lag_stats()
+    lines = [
+        "# TYPE tgproxy_connections_total counter",
+        f"tgproxy_connections_total {total_connections}",
+        "# TYPE tgproxy_connections_successful_total counter",
+        f"tgproxy_connections_successful_total {successful_connections}",
+        "# TYPE tgproxy_invalid_socks_total counter",
+        f"tgproxy_invalid_socks_total {invalid_socks_count}",
+        "# TYPE tgproxy_proxies_available gauge",
+        f"tgproxy_proxies_available {len(proxy_list)}",
+        "# TYPE tgproxy_proxies_blacklisted gauge",
+        f"tgproxy_proxies_blacklisted {len(proxy_blacklist)}",
+        "# TYPE tgproxy_throughput_aggregate_bytes_per_second gauge",
+        f"tgproxy_throughput_aggregate_bytes_per_second {throughput['aggregate_bps']}",
+        "# TYPE tgproxy_throughput_best_single_bytes_per_second gauge",
+        f"tgproxy_throughput_best_single_bytes_per_second {throughput['best_single_bps']}",
+        "# TYPE tgproxy_upstreams_used gauge",
+        f"tgproxy_upstreams_used {throughput['upstreams_used']}",
+        "# TYPE tgproxy_loop_lag_seconds summary",
+    ]
+    for quantile, key in (("0.5", "p50_ms"), ("0.9", "p90_ms"), ("0.99", "p99_ms")):
+        lines.append(f'tgproxy_loop_lag_seconds{{quantile="{quantile}"}} {lag[key] / 1000:.6f}')
+    lines += [
+        f"tgproxy_loop_lag_seconds_count {lag['samples']}",
+        "# TYPE tgproxy_loop_lag_max_seconds gauge",
+        f"tgproxy_loop_lag_max_seconds {lag['max_ms'] / 1000:.6f}",
+        "# TYPE tgproxy_slow_callbacks_total counter",
+        f"tgproxy_slow_callbacks_total {slow_callback_count}",
+    ]
+    for name, key in (("listening", "listening_s"), ("first_upstream", "first_upstream_s"),
+                      ("first_accept", "first_accept_s")):
+        if startup[key] is not None:
+            lines += [
+                f"# TYPE tgproxy_startup_{name}_seconds gauge",
+                f"tgproxy_startup_{name}_seconds {startup[key]:.3f}",
+            ]
+    body = "\n".join(lines) + "\n"
+
+    response = "HTTP/1.1 200 OK\r\n"
+    response += "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+    response += f"Content-Length: {len(body.encode('utf-8'))}\r\n"
+    response += "Connection: close\r\n\r\n"
+    response += body
+
+    return response
+
+
 def generate_404():
     """Генерирует 404 страницу"""
     html = "<h1>404 Not Found</h1>"
@@ -665,48 +2157,284 @@ def generate_404():
     return response
 
 
+# Параметры, которые нельзя применить без перезапуска
+RESTART_REQUIRED = {"LOCAL_HOST", "LOCAL_PORT",
+                    "HTTP_CONNECT_ENABLED", "HTTP_CONNECT_HOST", "HTTP_CONNECT_PORT"}
+# Параметры, при изменении которых нужно заново загрузить список прокси
+PROXY_FILTER_SETTINGS = {"PROXY_LIST_URL", "MAX_PING", "ALLOWED_COUNTRIES",
+                         "EXCLUDED_COUNTRIES", "MIN_PROXY_AGE"}
+
+
+async def reload_config():
+    """Перечитывает config.py и применяет новые значения без перезапуска"""
+    global loop_lag_samples, slow_callbacks
+
+    import importlib
+    try:
+        import config
+        config = importlib.reload(config)
+    except Exception as e:
+        print_error(f"Не удалось перечитать config.py: {e}")
+        return
+
+    module = globals()
+    changed = []
+    for name in dir(config):
+        if not name.isupper() or name not in module or name in RESTART_REQUIRED:
+            continue
+        value = getattr(config, name)
+        if module[name] != value:
+            module[name] = value
+            changed.append(name)
+
+    for name in RESTART_REQUIRED:
+        if getattr(config, name, module[name]) != module[name]:
+            print_error(f"{name} применится только после перезапуска (или передачи сокетов, SIGUSR2)")
+
+    if not changed:
+        print_info("🔄 config.py перечитан, изменений нет")
+        return
+    print_info(f"🔄 config.py перечитан, изменено: {', '.join(sorted(changed))}")
+
+    if CLIENT_AUTH:
+        load_users()
+    publish_routing()
+    if "LOOP_LAG_WINDOW" in changed:
+        loop_lag_samples = deque(loop_lag_samples, maxlen=LOOP_LAG_WINDOW)
+    if "SLOW_CALLBACK_HISTORY" in changed:
+        slow_callbacks = deque(slow_callbacks, maxlen=SLOW_CALLBACK_HISTORY)
+    if PROXY_FILTER_SETTINGS.intersection(changed):
+        # Новые фильтры - загружаем и проверяем список заново
+        if await refresh_proxy_list() and not current_proxy_listed():
+            select_random_proxy()
+
+
+def save_state():
+    """Сохраняет состояние upstream прокси во временный файл для нового процесса"""
+    import json
+    import tempfile
+
+    state = {
+        "proxy_list": proxy_list,
+        "current_proxy": current_proxy,
+        "proxy_blacklist": list(proxy_blacklist),
+        "upstream_stats": {key: dict(stats, active=0) for key, stats in list(upstream_stats.items())}
+    }
+    fd, path = tempfile.mkstemp(prefix="tgproxy-state-", suffix=".json")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    return path
+
+
+def restore_state():
+    """Восстанавливает состояние, переданное старым процессом"""
+    import json
+    global proxy_list, current_proxy, last_proxy_switch
+
+    path = os.environ.pop("TGPROXY_STATE_FILE", None)
+    if not path:
+        return False
+    try:
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+        os.unlink(path)
+    except (OSError, ValueError) as e:
+        print_error(f"Не удалось восстановить состояние: {e}")
+        return False
+
+    proxy_list = state["proxy_list"]
+    current_proxy = state["current_proxy"]
+    last_proxy_switch = time.time()
+    proxy_blacklist.update(state["proxy_blacklist"])
+    upstream_stats.update(state["upstream_stats"])
+    print_info(f"Состояние восстановлено: {len(proxy_list)} прокси, "
+               f"{len(proxy_blacklist)} в blacklist")
+    return bool(proxy_list and current_proxy)
+
+
+async def start_listener(name, handler, host, port, **kwargs):
+    """Запускает сервер на унаследованном от старого процесса сокете или новом"""
+    inherited = dict(
+        item.split(":") for item in os.environ.get("TGPROXY_LISTEN_FDS", "").split(",") if item
+    )
+    if name in inherited:
+        sock = socket.socket(fileno=int(inherited[name]))
+        server = await asyncio.start_server(handler, sock=sock, **kwargs)
+    else:
+        server = await asyncio.start_server(handler, host, port, **kwargs)
+    listeners[name] = server
+    return server
+
+
+def close_listeners():
+    """Закрывает слушающие сокеты (каждый - в потоке его event loop)"""
+    for server in listeners.values():
+        server.get_loop().call_soon_threadsafe(server.close)
+
+
+def notify_parent_ready():
+    """Сообщает старому процессу, что новый процесс принимает соединения"""
+    ready_fd = os.environ.pop("TGPROXY_READY_FD", None)
+    os.environ.pop("TGPROXY_LISTEN_FDS", None)
+    if ready_fd:
+        os.write(int(ready_fd), b"1")
+        os.close(int(ready_fd))
+
+
+def wait_child_ready(read_fd, timeout):
+    """Ждет сигнала готовности от нового процесса (выполняется в потоке)"""
+    import select
+
+    try:
+        readable, _, _ = select.select([read_fd], [], [], timeout)
+        return bool(readable) and os.read(read_fd, 1) == b"1"
+    finally:
+        os.close(read_fd)
+
+
+async def handover_listeners():
+    """Передает слушающие сокеты новому процессу и плавно завершает текущий"""
+    global handover_in_progress
+
+    if handover_in_progress:
+        return
+    handover_in_progress = True
+
+    import subprocess
+
+    fds = {name: server.sockets[0].fileno() for name, server in listeners.items()}
+    read_fd, write_fd = os.pipe()
+    env = dict(
+        os.environ,
+        TGPROXY_LISTEN_FDS=",".join(f"{name}:{fd}" for name, fd in fds.items()),
+        TGPROXY_READY_FD=str(write_fd),
+        TGPROXY_STATE_FILE=save_state()
+    )
+
+    print_info("🔁 Запуск нового процесса и передача ему слушающих сокетов...")
+    try:
+        process = subprocess.Popen([sys.executable] + sys.argv, env=env,
+                                   pass_fds=list(fds.values()) + [write_fd])
+    except OSError as e:
+        print_error(f"Не удалось запустить новый процесс: {e}")
+        os.close(read_fd)
+        handover_in_progress = False
+        return
+    finally:
+        os.close(write_fd)
+
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, wait_child_ready, read_fd, HANDOVER_TIMEOUT):
+        print_error("Новый процесс не подтвердил готовность, продолжаем работу")
+        process.terminate()
+        handover_in_progress = False
+        return
+
+    # Новый процесс принимает соединения - перестаем принимать новые и дожидаемся текущих
+    close_listeners()
+    print_info(f"✅ Сокеты переданы процессу {process.pid}, завершаем {active_clients} соединений...")
+
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while active_clients > 0 and time.monotonic() < deadline:
+        await asyncio.sleep(1)
+    if active_clients:
+        print_error(f"Таймаут ожидания, прерываем {active_clients} соединений")
+    shutdown_event.set()
+
+
+def install_signal_handlers():
+    """SIGHUP - перечитать config.py, SIGUSR2 - передать сокеты новому процессу"""
+    loop = asyncio.get_running_loop()
+    if not hasattr(signal, "SIGHUP"):
+        return  # Windows: сигналы не поддерживаются
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.run_coroutine_threadsafe(reload_config(), control_loop))
+    loop.add_signal_handler(signal.SIGUSR2, lambda: asyncio.ensure_future(handover_listeners()))
+
+
 async def main():
     """Главная функция"""
+    global shutdown_event
     print_info("=" * 60)
     print_info("Telegram SOCKS5 Proxy")
     print_info("=" * 60)
+    if config_error:
+        print_error(f"config.py не загружен ({config_error}), используются значения по умолчанию")
+    if missing_settings:
+        print_info(f"В config.py нет настроек {', '.join(missing_settings)} - используются значения по умолчанию")
     
-    # Загружаем начальный список прокси
-    if not load_proxy_list():
-        print_error("Не удалось загрузить список прокси. Выход.")
-        return
+    shutdown_event = asyncio.Event()
+    start_control_plane()
     
-    # Выбираем случайный прокси
-    if not select_random_proxy():
-        print_error("Не удалось выбрать прокси. Выход.")
-        return
+    if restore_state():
+        # Состояние передано старым процессом - список обновим в фоне
+        startup["source"] = "state"
+        asyncio.run_coroutine_threadsafe(refresh_proxy_list(), control_loop)
+    elif FAST_START:
+        # Быстрый старт: порты открываются сразу, а список загружается в фоне.
+        # До загрузки клиенты идут через прокси из кэша прошлого запуска
+        # или ждут первый upstream до FAST_START_HOLD секунд
+        if load_upstream_cache() and select_random_proxy():
+            startup["source"] = "cache"
+        asyncio.run_coroutine_threadsafe(load_initial_proxy_list(), control_loop)
+    else:
+        # Загружаем начальный список прокси (проверка кандидатов продолжится в control plane)
+        if not await run_in_control_plane(refresh_proxy_list()):
+            print_error("Не удалось загрузить список прокси. Выход.")
+            return
+        
+        # Выбираем случайный прокси
+        if not select_random_proxy():
+            print_error("Не удалось выбрать прокси. Выход.")
+            return
+        startup["source"] = "download"
     
-    # Запускаем фоновые задачи
-    asyncio.create_task(update_proxy_list_periodically())
-    asyncio.create_task(print_statistics_periodically())
-    asyncio.create_task(clean_blacklist_periodically())
+    if CLIENT_AUTH:
+        load_users()
+        if not users:
+            print_error(f"CLIENT_AUTH включен, но в {USERS_FILE} нет пользователей - подключиться никто не сможет")
     
     # Запускаем SOCKS5 сервер
-    socks_server = await asyncio.start_server(
+    socks_server = await start_listener(
+        "socks",
         handle_socks5_client,
         LOCAL_HOST,
         LOCAL_PORT
     )
     
-    # Запускаем HTTP сервер (веб-интерфейс)
-    http_server = await asyncio.start_server(
-        handle_http_request,
-        "0.0.0.0",
-        5000
-    )
+    # Запускаем HTTP CONNECT прокси для клиентов без поддержки SOCKS5
+    connect_server = None
+    if HTTP_CONNECT_ENABLED:
+        connect_server = await start_listener(
+            "http_connect",
+            handle_http_connect_client,
+            HTTP_CONNECT_HOST,
+            HTTP_CONNECT_PORT,
+            limit=HTTP_MAX_HEADER_SIZE  # readuntil не прочитает заголовок длиннее лимита
+        )
+    startup["listening_s"] = round(time.monotonic() - PROCESS_STARTED, 3)
+    
+    # Запускаем фоновые задачи и веб-интерфейс в control plane
+    if LOOP_MONITOR:
+        start_loop_lag_monitor()
+    http_server = await run_in_control_plane(start_control_tasks())
+    
+    notify_parent_ready()
+    install_signal_handlers()
     
     socks_addr = socks_server.sockets[0].getsockname()
     http_addr = http_server.sockets[0].getsockname()
     
     print_info("=" * 60)
     print_info(f"✅ SOCKS5 прокси запущен на {socks_addr[0]}:{socks_addr[1]}")
+    if connect_server:
+        connect_addr = connect_server.sockets[0].getsockname()
+        print_info(f"✅ HTTP CONNECT прокси запущен на {connect_addr[0]}:{connect_addr[1]}")
     print_info(f"✅ Веб-интерфейс запущен на http://{http_addr[0]}:{http_addr[1]}")
-    print_info(f"🌍 Upstream прокси: {current_proxy['ip']}:{current_proxy['port']}")
+    print_info(f"⚡ Порты открыты через {startup['listening_s']}с после запуска")
+    if current_proxy:
+        print_info(f"🌍 Upstream прокси: {current_proxy['ip']}:{current_proxy['port']}")
+    else:
+        print_info("🌍 Upstream прокси: список загружается в фоне")
     print_info("=" * 60)
     print_info(f"Настройте Telegram для использования SOCKS5 прокси:")
     print_info(f"  Сервер: {socks_addr[0]}")
@@ -715,11 +2443,10 @@ async def main():
     print_info(f"🌐 Откройте в браузере: http://localhost:{http_addr[1]}")
     print_info("=" * 60)
     
-    async with socks_server, http_server:
-        await asyncio.gather(
-            socks_server.serve_forever(),
-            http_server.serve_forever()
-        )
+    try:
+        await shutdown_event.wait()
+    finally:
+        close_listeners()
 
 
 if __name__ == "__main__":